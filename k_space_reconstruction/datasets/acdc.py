@@ -1,6 +1,9 @@
 import os
 import re
+import json
+import hashlib
 import cv2
+import h5py
 import gdown
 import numpy as np
 import nibabel
@@ -9,11 +12,23 @@ import torch.utils.data
 import pytorch_lightning as pl
 from tqdm import tqdm
 from typing import Any, Union, List, Optional
+from multiprocessing import Pool
 from os.path import isdir, join
 from torch.utils.data.dataset import T_co
 from torch.utils.data import Dataset, DataLoader, random_split
-from k_space_reconstruction.utils.kspace import RandomMaskFunc, MaskFunc, spatial2kspace, kspace2spatial, apply_mask
-from k_space_reconstruction.utils.io import get_dir_md5hash, get_file_md5hash
+from k_space_reconstruction.utils.kspace import RandomMaskFunc, MaskFunc, apply_mask
+from k_space_reconstruction.utils.kspace import fft2c, ifft2c
+from k_space_reconstruction.utils.io import get_dir_md5hash_cached, H5FilePool
+from k_space_reconstruction.utils.cache import LRUCache
+from k_space_reconstruction.datasets.index import get_manifest, default_index_path, INDEX_SUFFIX
+from k_space_reconstruction.datasets.batch import BatchCollator
+from k_space_reconstruction.datasets.sampler import VolumeLocalitySampler
+from k_space_reconstruction.datasets.autotune import loader_kwargs, resolve_loader_config
+from k_space_reconstruction.utils.threads import CoreBudget
+
+
+def scan_nifti(fp: str) -> dict:
+    return {'shape': list(nibabel.load(fp).shape)}
 
 
 class ACDCTransform(object):
@@ -30,16 +45,16 @@ class ACDCTransform(object):
         return x, mean, std
 
     def __call__(self, f_name: str, slice_id: str, k_space: np.ndarray, max_val: float):
-        recon = kspace2spatial(k_space)
+        recon = np.abs(ifft2c(k_space))
         xs = (k_space.shape[0] - self.target_shape[0]) // 2
         ys = (k_space.shape[1] - self.target_shape[1]) // 2
         xt = xs + self.target_shape[0]
         yt = ys + self.target_shape[1]
         recon = recon[xs:xt, ys:yt]
-        k_space = spatial2kspace(recon)
+        k_space = fft2c(recon)
         if self.mask_f:
             k_space, mask = apply_mask(k_space, self.mask_f)
-        sampled_image = kspace2spatial(k_space)
+        sampled_image = np.abs(ifft2c(k_space))
         sampled_image, mean, std = self.normalize(sampled_image)
         target = (recon - mean) / (std + 1e-11)
 
@@ -53,44 +68,144 @@ class ACDCTransform(object):
         return k_space, mask, target, sampled_image, mean, std, f_name, slice_id, max_val
 
 
+def load_frame(f: str, t: int) -> np.ndarray:
+    img = nibabel.load(f).dataobj[:, :, :, t]
+    img = img.astype(np.float64) / img.max()
+    return cv2.resize(img, (400, 400))
+
+
+def prepare_frame(f: str, t: int):
+    """Resized k-space stack (Z, 400, 400) and maxval of frame t of a 4D scan."""
+    img = load_frame(f, t)
+    ks = fft2c(np.moveaxis(img, 2, 0))
+    ks = ks * 1e2
+    maxval = np.abs(ifft2c(ks)).max()
+    return ks, maxval
+
+
+def _prepare_frame(args):
+    return prepare_frame(*args)
+
+
+def _frame_nbytes(frame) -> int:
+    return frame[0].nbytes
+
+
+def frame_key(name: str, t: int) -> str:
+    return '%s/%d' % (name, t)
+
+
+# Bump when prepare_frame changes, stores written by older code are then rebuilt
+ACDC_STORE_VERSION = 1
+
+
+def acdc_fingerprint(files: dict) -> str:
+    """Digest of the scans (name, size, mtime) backing a k-space store and of the store layout."""
+    stats = [(name, os.stat(fp).st_size, os.stat(fp).st_mtime_ns) for name, fp in sorted(files.items())]
+    return hashlib.md5(json.dumps({'version': ACDC_STORE_VERSION, 'source': stats}).encode()).hexdigest()
+
+
+def is_acdc_store(path: str, fingerprint: str) -> bool:
+    if not os.path.exists(path):
+        return False
+    with h5py.File(path, 'r') as hf:
+        return hf.attrs.get('fingerprint') == fingerprint
+
+
 class ACDCSet(Dataset):
+    """
+    Prepared frames (resized k-space stack and maxval) are kept in a per-worker LRU cache of at most
+    `cache_bytes`. The cache only pays off when slices of a frame are read close together (sequential
+    order or VolumeLocalitySampler over `frame_groups`), 0 disables it. With `store_path` they are read slice by slice from a store written by
+    `export_acdc_kspace`, which is created on first use and rebuilt when the scans change.
+    """
     IMG4D_PATTERN = r'^patient\d+_4d.nii.gz'
+    # The frame cache is shared by the threads of a ThreadPoolLoader, which then fetches one sample at a time
+    thread_safe = False
 
-    def __init__(self, dir_path, transform: ACDCTransform):
+    def __init__(self, dir_path, transform: ACDCTransform, index_path=None, num_workers=None,
+                 cache_bytes=512 * 2 ** 20, store_path=None):
         super().__init__()
         self.dir = dir_path
         self.transform = transform
         self._images = []
+        files = {}
         patients = [d for d in os.listdir(dir_path) if not d.startswith('.') and isdir(join(dir_path, d))]
         for patient in sorted(patients):
             for f in sorted(os.listdir(join(self.dir, patient))):
                 if re.findall(self.IMG4D_PATTERN, f):
-                    self._images += self.load_scan_slice(join(self.dir, patient, f))
+                    files[join(patient, f)] = join(self.dir, patient, f)
+        self.index = get_manifest(files, scan_nifti, index_path or default_index_path(dir_path), num_workers)
+        for name in sorted(files.keys()):
+            self._images += self.load_scan_slice(files[name], self.index[name]['shape'])
+        self._names = {fp: name for name, fp in files.items()}
+        self.fingerprint = acdc_fingerprint(files)
+        self.frames = LRUCache(max_bytes=cache_bytes, sizeof=_frame_nbytes)
+        self.store_path = store_path
+        self.files = H5FilePool(max_open=1)
+        if store_path is not None and not is_acdc_store(store_path, self.fingerprint):
+            export_acdc_kspace(self, store_path, num_workers)
 
     @staticmethod
-    def load_scan_slice(f: str):
-        scan = nibabel.load(f)
+    def load_scan_slice(f: str, shape=None):
+        if shape is None:
+            shape = nibabel.load(f).shape
         images = []
-        for i in range(scan.shape[2]):
-            for j in range(scan.shape[3]):
+        for i in range(shape[2]):
+            for j in range(shape[3]):
                 images.append((f, i, j))
         return images
 
+    def frame_groups(self) -> List[List[int]]:
+        """Dataset indices grouped by frame, the unit of the frame cache."""
+        groups = {}
+        for i, (f, _, t) in enumerate(self._images):
+            groups.setdefault((f, t), []).append(i)
+        return list(groups.values())
+
+    def frame_list(self):
+        return sorted(set((f, t) for f, _, t in self._images), key=lambda x: (self._names[x[0]], x[1]))
+
+    def load_frame(self, f: str, t: int):
+        frame = self.frames.get((f, t))
+        if frame is None:
+            frame = prepare_frame(f, t)
+            self.frames.put((f, t), frame)
+        return frame
+
     def __len__(self):
         return len(self._images)
 
     def __getitem__(self, index) -> T_co:
         f, slice_z, t = self._images[index]
-        img = nibabel.load(f).dataobj[:, :, :, t]
-        img = img.astype(np.float) / img.max()
-        img = cv2.resize(img, (400, 400))
-        ks = np.stack([spatial2kspace(img[:, :, i]) for i in range(img.shape[2])])
-        ks = ks * 1e2
-        maxval = np.stack([kspace2spatial(k) for k in ks]).max()
-        if self.transform:
-            return self.transform(f, '%d_%d' % (slice_z, t), ks[slice_z], maxval)
-        else:
-            return torch.as_tensor(img, dtype=torch.float)
+        if not self.transform:
+            return torch.as_tensor(load_frame(f, t), dtype=torch.float)
+        if self.store_path is not None:
+            ds = self.files.get(self.store_path)[frame_key(self._names[f], t)]
+            ks, maxval = ds[slice_z], ds.attrs['maxval']
+            return self.transform(f, '%d_%d' % (slice_z, t), ks, maxval)
+        ks, maxval = self.load_frame(f, t)
+        return self.transform(f, '%d_%d' % (slice_z, t), ks[slice_z], maxval)
+
+
+def export_acdc_kspace(dataset: ACDCSet, out_path: str, num_workers=None) -> str:
+    """
+    Writes the resized k-space of every frame of an ACDCSet to one .h5 file, one complex64 (Z, 400, 400)
+    dataset with a maxval attribute per frame, so epochs no longer decompress the gzip NIfTI scans.
+    The fingerprint of the scans is kept in the file attributes.
+    """
+    frames = dataset.frame_list()
+    tmp_path = out_path + '.tmp'
+    if num_workers is None:
+        num_workers = os.cpu_count() or 1
+    with h5py.File(tmp_path, 'w') as hf, Pool(max(num_workers, 1)) as pool:
+        for (f, t), (ks, maxval) in zip(frames, pool.imap(_prepare_frame, frames)):
+            ds = hf.create_dataset(frame_key(dataset._names[f], t), data=ks.astype(np.complex64),
+                                   chunks=(1,) + ks.shape[1:])
+            ds.attrs['maxval'] = maxval
+        hf.attrs['fingerprint'] = dataset.fingerprint
+    os.replace(tmp_path, out_path)
+    return out_path
 
 
 class PlACDCDataModule(pl.LightningDataModule):
@@ -100,22 +215,32 @@ class PlACDCDataModule(pl.LightningDataModule):
     DIR_HASH = 'cb0290e1efb2f752edfd48165db5d04c'
     TAR_HASH = '397d550418e639b722faa95a671986b9'
 
-    def __init__(self, root_dir, transform, batch_size=1, num_workers=0, prefetch_factor=2, random_seed=42, train_val_split=0.2):
+    def __init__(self, root_dir, transform, batch_size=1, num_workers=0, prefetch_factor=2, random_seed=42, train_val_split=0.2,
+                 persistent_workers=False, thread_budget=False, reuse_buffers=False, locality_window=None):
         super().__init__()
         self.root_dir = root_dir
         self.transform = transform
+        # 'auto' takes the value datasets/autotune.py found for ACDCSet on this machine
         self.batch_size = batch_size
         self.prefetch_factor = prefetch_factor
         self.num_workers = num_workers
+        self.persistent_workers = persistent_workers
+        # Split the cores between the model and the workers (cv2.resize included), see utils/threads.py
+        self.thread_budget = thread_budget
+        self.core_budget = None
         self._train = None
         self._val = None
         self._test = None
         self.random_seed = random_seed
         self.train_val_split = train_val_split
+        # Without workers batches are collated in this process and can reuse a ring of buffers
+        self.reuse_buffers = reuse_buffers
+        # Shuffle slices within windows of this many frames, the train frame cache is off without it
+        self.locality_window = locality_window
 
     def prepare_data(self):
         if os.path.exists(join(self.root_dir, self.DIR_NAME)) and os.path.isdir(join(self.root_dir, self.DIR_NAME)):
-            if get_dir_md5hash(join(self.root_dir, self.DIR_NAME)) == self.DIR_HASH:
+            if get_dir_md5hash_cached(join(self.root_dir, self.DIR_NAME)) == self.DIR_HASH:
                 return True
             raise ValueError('Wrong checksum, delete %s dir' % self.root_dir)
         gdown.cached_download('https://drive.google.com/uc?id=1-yZki-hyVcHKWB4VfqAUaAfBazPyemqN',
@@ -124,22 +249,46 @@ class PlACDCDataModule(pl.LightningDataModule):
         return True
 
     def setup(self, stage: Optional[str] = None):
-        self._train = ACDCSet(join(self.root_dir, self.DIR_NAME, self.DIR_TRAIN), self.transform)
-        self._val = ACDCSet(join(self.root_dir, self.DIR_NAME, self.DIR_TEST), self.transform)
+        # Manifests are kept out of the checksummed dir
+        train_index = join(self.root_dir, 'acdc_training' + INDEX_SUFFIX)
+        test_index = join(self.root_dir, 'acdc_testing' + INDEX_SUFFIX)
+        # A fully shuffled epoch almost never reads a cached frame again
+        train_cache = {} if self.locality_window else {'cache_bytes': 0}
+        self._train = ACDCSet(join(self.root_dir, self.DIR_NAME, self.DIR_TRAIN), self.transform, train_index,
+                              **train_cache)
+        self._val = ACDCSet(join(self.root_dir, self.DIR_NAME, self.DIR_TEST), self.transform, test_index)
         # TODO: ?
-        self._test = ACDCSet(join(self.root_dir, self.DIR_NAME, self.DIR_TEST), self.transform)
+        self._test = ACDCSet(join(self.root_dir, self.DIR_NAME, self.DIR_TEST), self.transform, test_index)
+        config = resolve_loader_config(type(self._train).__name__, batch_size=self.batch_size,
+                                       num_workers=self.num_workers, prefetch_factor=self.prefetch_factor,
+                                       persistent_workers=self.persistent_workers)
+        self.batch_size = config['batch_size']
+        self.num_workers = config['num_workers']
+        self.prefetch_factor = config['prefetch_factor']
+        self.persistent_workers = config['persistent_workers']
+        if self.thread_budget and self.core_budget is None:
+            self.core_budget = CoreBudget.from_env(self.num_workers)
+            self.core_budget.apply_main()
+
+    def loader(self, dataset: Dataset, shuffle: bool, sampler=None) -> DataLoader:
+        worker_init_fn = self.core_budget.worker_init_fn if self.core_budget is not None and self.num_workers else None
+        reuse = self.reuse_buffers and not self.num_workers
+        collate_fn = BatchCollator(num_buffers=BatchCollator.ring_size()) if reuse else BatchCollator()
+        return DataLoader(dataset, batch_size=self.batch_size, shuffle=shuffle, sampler=sampler, collate_fn=collate_fn,
+                          worker_init_fn=worker_init_fn, **loader_kwargs(self.num_workers, self.prefetch_factor, self.persistent_workers))
 
     def train_dataloader(self, *args, **kwargs) -> DataLoader:
-        return DataLoader(self._train, batch_size=self.batch_size, shuffle=True,
-                          num_workers=self.num_workers, prefetch_factor=self.prefetch_factor)
+        if self.locality_window:
+            sampler = VolumeLocalitySampler(self._train, self.locality_window, volumes=self._train.frame_groups(),
+                                            seed=self.random_seed)
+            return self.loader(self._train, shuffle=False, sampler=sampler)
+        return self.loader(self._train, shuffle=True)
 
     def val_dataloader(self, *args, **kwargs) -> Union[DataLoader, List[DataLoader]]:
-        return DataLoader(self._val, batch_size=self.batch_size, shuffle=False,
-                          num_workers=self.num_workers, prefetch_factor=self.prefetch_factor)
+        return self.loader(self._val, shuffle=False)
 
     def test_dataloader(self, *args, **kwargs) -> Union[DataLoader, List[DataLoader]]:
-        return DataLoader(self._test, batch_size=self.batch_size, shuffle=False,
-                          num_workers=self.num_workers, prefetch_factor=self.prefetch_factor)
+        return self.loader(self._test, shuffle=False)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,185 @@
+import os
+import json
+import time
+import socket
+import argparse
+import itertools
+import numpy as np
+from os.path import join, exists, expanduser
+from typing import Callable, Dict, Optional, Sequence
+from torch.utils.data import Dataset, DataLoader, IterableDataset, Subset
+
+
+PROFILE_DIR = os.environ.get('KSR_PROFILE_DIR', join(expanduser('~'), '.cache', 'k_space_reconstruction'))
+# Loader settings used when a machine has no profile yet
+DEFAULT_CONFIG = {'num_workers': min(12, os.cpu_count() or 1), 'prefetch_factor': 2, 'persistent_workers': False}
+
+
+def machine_id() -> str:
+    return '%s-%dcpu' % (socket.gethostname(), os.cpu_count() or 1)
+
+
+def profile_path() -> str:
+    return join(PROFILE_DIR, 'loader-%s.json' % machine_id())
+
+
+def load_loader_profile() -> Dict[str, dict]:
+    """Best loader settings of this machine per dataset class name, empty without a profile."""
+    if not exists(profile_path()):
+        return {}
+    with open(profile_path(), 'r') as f:
+        return json.load(f)
+
+
+def save_loader_profile(key: str, config: dict):
+    profile = load_loader_profile()
+    profile[key] = config
+    os.makedirs(PROFILE_DIR, exist_ok=True)
+    tmp = profile_path() + '.tmp'
+    with open(tmp, 'w') as f:
+        json.dump(profile, f, indent=1)
+    os.replace(tmp, profile_path())
+
+
+def loader_kwargs(num_workers: int, prefetch_factor: Optional[int] = 2, persistent_workers: bool = False) -> dict:
+    """DataLoader kwargs, prefetch_factor and persistent_workers only apply with worker processes."""
+    if not num_workers:
+        return {'num_workers': 0}
+    return {'num_workers': num_workers, 'prefetch_factor': prefetch_factor, 'persistent_workers': persistent_workers}
+
+
+def loader_profile_kwargs(key: str = 'FastMRIh5Dataset') -> dict:
+    """
+    num_workers, prefetch_factor and persistent_workers found by `autotune_loader` for `key` on this machine,
+    DEFAULT_CONFIG without a profile. The batch size is left to the caller:
+
+        train_generator = DataLoader(train_dataset, batch_size=8, shuffle=True, **loader_profile_kwargs())
+    """
+    config = load_loader_profile().get(key, DEFAULT_CONFIG)
+    return loader_kwargs(config['num_workers'], config['prefetch_factor'], config['persistent_workers'])
+
+
+def resolve_loader_config(key: str, **config) -> dict:
+    """Replaces 'auto' values of batch_size, num_workers, prefetch_factor and persistent_workers from the profile."""
+    profile = load_loader_profile().get(key)
+    auto = [k for k, v in config.items() if v == 'auto']
+    if auto and profile is None:
+        print('No loader profile for %s on %s, using defaults for %s (run datasets/autotune.py)'
+              % (key, machine_id(), ', '.join(auto)))
+    for k in auto:
+        if profile is not None and k in profile:
+            config[k] = profile[k]
+        elif k == 'batch_size':
+            config[k] = 1
+        else:
+            config[k] = DEFAULT_CONFIG[k]
+    return config
+
+
+def time_loader(dataset: Dataset, batch_size: int, num_workers: int, prefetch_factor: int = 2,
+                persistent_workers: bool = False, num_batches: int = 20, epochs: int = 2,
+                collate_fn: Optional[Callable] = None) -> float:
+    """
+    Samples per second of `epochs` passes over the first `num_batches` batches, worker start up included,
+    so persistent workers pay off from the second epoch on like in training. Iterable datasets are read
+    in their own order and stopped after `num_batches`.
+    """
+    num_samples = min(len(dataset), batch_size * num_batches)
+    if isinstance(dataset, IterableDataset):
+        loader = DataLoader(dataset, batch_size=batch_size, collate_fn=collate_fn,
+                            **loader_kwargs(num_workers, prefetch_factor, persistent_workers))
+    else:
+        loader = DataLoader(Subset(dataset, np.arange(num_samples)), batch_size=batch_size, shuffle=True,
+                            collate_fn=collate_fn, **loader_kwargs(num_workers, prefetch_factor, persistent_workers))
+    t = time.perf_counter()
+    for _ in range(epochs):
+        for _ in itertools.islice(loader, num_batches):
+            pass
+    elapsed = time.perf_counter() - t
+    # Shuts persistent workers down before the next trial
+    del loader
+    return epochs * num_samples / elapsed
+
+
+def autotune_loader(dataset: Dataset, key: Optional[str] = None, batch_sizes: Sequence[int] = (8,),
+                    workers: Optional[Sequence[int]] = None, prefetch_factors: Sequence[int] = (2, 4),
+                    persistent_workers: Sequence[bool] = (False, True), num_batches: int = 20,
+                    collate_fn: Optional[Callable] = None, save: bool = True) -> dict:
+    """
+    Times short DataLoader runs and keeps the configuration with the most samples per second.
+    Worker counts and batch sizes are searched first with prefetch_factor=2 and no persistent workers,
+    prefetch factors and persistent workers then only around the best of them.
+
+    Args:
+        dataset: Dataset with its transform, e.g. FastMRIh5Dataset.
+        key: Profile entry, the dataset class name by default (what the data modules look up).
+        workers: Worker counts to try, powers of two up to the number of cores by default.
+        save: Write the best configuration to the profile of this machine.
+
+    Returns:
+        Best config: batch_size, num_workers, prefetch_factor, persistent_workers, samples_per_sec
+    """
+    key = key or type(dataset).__name__
+    if workers is None:
+        cores = os.cpu_count() or 1
+        workers = sorted({0, cores} | {2 ** i for i in range(int(np.log2(cores)) + 1)})
+    trials = []
+
+    def trial(batch_size, num_workers, prefetch_factor, persistent):
+        if not num_workers and (prefetch_factor != 2 or persistent):
+            return
+        speed = time_loader(dataset, batch_size, num_workers, prefetch_factor, persistent, num_batches,
+                            collate_fn=collate_fn)
+        print('batch_size=%d num_workers=%d prefetch_factor=%d persistent_workers=%s: %.1f samples/s'
+              % (batch_size, num_workers, prefetch_factor, persistent, speed))
+        trials.append({'batch_size': batch_size, 'num_workers': num_workers, 'prefetch_factor': prefetch_factor,
+                       'persistent_workers': persistent, 'samples_per_sec': speed})
+
+    for batch_size, num_workers in itertools.product(batch_sizes, workers):
+        trial(batch_size, num_workers, 2, False)
+    best = max(trials, key=lambda c: c['samples_per_sec'])
+    for prefetch_factor, persistent in itertools.product(prefetch_factors, persistent_workers):
+        if (prefetch_factor, persistent) != (2, False):
+            trial(best['batch_size'], best['num_workers'], prefetch_factor, persistent)
+    best = dict(max(trials, key=lambda c: c['samples_per_sec']), machine=machine_id(), time=time.time())
+    if save:
+        save_loader_profile(key, best)
+    return best
+
+
+if __name__ == '__main__':
+    from os.path import isdir
+    from k_space_reconstruction.utils.kspace import RandomMaskFunc
+    from k_space_reconstruction.datasets.fastmri import FastMRITransform, FastMRIDataset, FastMRIh5Dataset
+    from k_space_reconstruction.datasets.memmap import FastMRIMemmapDataset
+    from k_space_reconstruction.datasets.shared import FastMRISharedDataset
+    from k_space_reconstruction.datasets.stream import FastMRIStreamDataset
+
+    # Train datasets PlFastMRIkneeDataModule builds, the profile is keyed by their class name:
+    # raw (dir or .h5 by path), in_memory=True, memmap=True and stream_buffer=N
+    DATASETS = {
+        'raw': lambda path, t, args: (FastMRIDataset if isdir(path) else FastMRIh5Dataset)(path, t),
+        'shared': lambda path, t, args: FastMRISharedDataset(path, t),
+        'memmap': lambda path, t, args: FastMRIMemmapDataset(path, t),
+        'stream': lambda path, t, args: FastMRIStreamDataset(path, t, args.stream_buffer),
+    }
+
+    parser = argparse.ArgumentParser(description='Find the fastest DataLoader settings of this machine')
+    parser.add_argument('path', help='fastMRI dir or packed .h5 file')
+    parser.add_argument('--dataset', choices=sorted(DATASETS.keys()), default='raw',
+                        help='backend the data module is configured with')
+    parser.add_argument('--stream-buffer', type=int, default=64, help='shuffle buffer of --dataset stream')
+    parser.add_argument('--batch-sizes', type=int, nargs='+', default=[8])
+    parser.add_argument('--workers', type=int, nargs='+', default=None)
+    parser.add_argument('--prefetch-factors', type=int, nargs='+', default=[2, 4])
+    parser.add_argument('--batches', type=int, default=20, help='batches per trial epoch')
+    parser.add_argument('--target-shape', type=int, nargs=2, default=[320, 320])
+    parser.add_argument('--noise-type', default='none')
+    parser.add_argument('--noise-level', type=float, default=0.0)
+    args = parser.parse_args()
+    transform = FastMRITransform(RandomMaskFunc([0.08], [4]), target_shape=tuple(args.target_shape),
+                                 noise_level=args.noise_level, noise_type=args.noise_type)
+    dataset = DATASETS[args.dataset](args.path, transform, args)
+    config = autotune_loader(dataset, batch_sizes=args.batch_sizes, workers=args.workers,
+                             prefetch_factors=args.prefetch_factors, num_batches=args.batches)
+    print('best for %s: %s -> %s' % (type(dataset).__name__, config, profile_path()))
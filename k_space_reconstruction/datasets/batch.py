@@ -0,0 +1,173 @@
+import torch
+from typing import List, Optional, Sequence
+from torch.utils.data import get_worker_info
+
+
+class ReconstructionBatch(object):
+    """
+    Batch of the 9 fields every transform returns. Fields are read by name, iterating (and tuple
+    unpacking) still yields them in the transform order:
+
+        ks, mask, y, x, mean, std, f_name, slice_id, max_val = batch
+    """
+    __slots__ = ('k_space', 'mask', 'target', 'sampled_image', 'mean', 'std', 'f_name', 'slice_id', 'max_val')
+
+    def __init__(self, k_space, mask, target, sampled_image, mean, std, f_name, slice_id, max_val):
+        self.k_space = k_space
+        self.mask = mask
+        self.target = target
+        self.sampled_image = sampled_image
+        self.mean = mean
+        self.std = std
+        self.f_name = f_name
+        self.slice_id = slice_id
+        self.max_val = max_val
+
+    @classmethod
+    def of(cls, batch) -> 'ReconstructionBatch':
+        """Wraps a collated 9-tuple, a ReconstructionBatch is returned as is."""
+        if isinstance(batch, cls):
+            return batch
+        return cls(*batch)
+
+    def __iter__(self):
+        return (getattr(self, k) for k in self.__slots__)
+
+    def __len__(self):
+        return len(self.__slots__)
+
+    def __getitem__(self, i):
+        return getattr(self, self.__slots__[i])
+
+    def __getstate__(self):
+        return tuple(self)
+
+    def __setstate__(self, state):
+        for k, v in zip(self.__slots__, state):
+            setattr(self, k, v)
+
+    def to(self, device, non_blocking: bool = False) -> 'ReconstructionBatch':
+        return ReconstructionBatch(*(x.to(device, non_blocking=non_blocking) if isinstance(x, torch.Tensor) else x
+                                     for x in self))
+
+    def pin_memory(self) -> 'ReconstructionBatch':
+        # Called by the DataLoader pin memory thread
+        return ReconstructionBatch(*(x.pin_memory() if isinstance(x, torch.Tensor) else x for x in self))
+
+
+class BatchCollator(object):
+    """
+    collate_fn building ReconstructionBatch, tensor fields are stacked into new (optionally pinned)
+    tensors. With `num_buffers` > 0 the main process (num_workers=0 or a ThreadPoolLoader) reuses a ring
+    of that many buffer sets instead, a batch then stays valid only until `num_buffers` more batches are
+    collated. Opt in only with one collator per loader and more buffers than batches are alive at once
+    (prefetch depth + the current batch + any kept for epoch end). In DataLoader workers every batch is
+    stacked straight into new shared memory, a buffer reused there would change batches already sent.
+
+        loader = DataLoader(dataset, batch_size=8, collate_fn=BatchCollator(pin_memory=True))
+    """
+
+    def __init__(self, num_buffers: int = 0, pin_memory: bool = False):
+        self.num_buffers = num_buffers
+        self.pin_memory = pin_memory
+        self._buffers: List[Optional[list]] = [None] * num_buffers
+        self._next = 0
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_buffers'] = [None] * self.num_buffers
+        return state
+
+    @staticmethod
+    def ring_size(prefetch_depth: int = 0) -> int:
+        """
+        Buffer sets of a collator in the main process: the batch of the current step, the one Lightning
+        fetches ahead and the one being collated, plus the queue of a BatchPrefetcher of `prefetch_depth`
+        and the batch its thread holds. Batches kept past the next step (e.g. for `*_epoch_end`) need more.
+        """
+        return 3 + (prefetch_depth + 1 if prefetch_depth else 0)
+
+    @staticmethod
+    def _as_tensor(field: Sequence):
+        if isinstance(field[0], torch.Tensor):
+            return None
+        if isinstance(field[0], str):
+            return list(field)
+        return torch.as_tensor(field, dtype=torch.float64 if isinstance(field[0], float) else None)
+
+    def _new_buffer(self, elem: torch.Tensor, n: int, shared: bool) -> torch.Tensor:
+        out = torch.empty((n,) + tuple(elem.shape), dtype=elem.dtype)
+        if shared:
+            return out.share_memory_()
+        return out.pin_memory() if self.pin_memory else out
+
+    def __call__(self, samples) -> ReconstructionBatch:
+        fields = list(zip(*samples))
+        n = len(samples)
+        shared = get_worker_info() is not None
+        buffers = None
+        if not shared and self.num_buffers:
+            buffers = self._buffers[self._next]
+            if buffers is None or any(b is not None and b.shape[0] != n for b in buffers):
+                buffers = [None] * len(fields)
+            self._buffers[self._next] = buffers
+            self._next = (self._next + 1) % self.num_buffers
+        out = []
+        for i, field in enumerate(fields):
+            value = self._as_tensor(field)
+            if value is not None:
+                out.append(value)
+                continue
+            elem = field[0]
+            if buffers is None:
+                buf = self._new_buffer(elem, n, shared)
+            else:
+                buf = buffers[i]
+                if buf is None or buf.shape[1:] != elem.shape or buf.dtype != elem.dtype:
+                    buf = buffers[i] = self._new_buffer(elem, n, False)
+            out.append(torch.stack(field, out=buf))
+        return ReconstructionBatch(*out)
+
+
+class LeanBatch(object):
+    """
+    Batch of undersampled slices as they come out of the loader workers, only the sampled k-space
+    columns are stored. `FastMRILeanTransform.expand` turns it into the dense ReconstructionBatch.
+
+    Attributes:
+        columns: (B, C) int64 sampled column numbers, rows with fewer columns are padded with `num_cols`.
+        measured: (B, H, C) complex64 k-space of those columns, zero in the padding.
+        recon: (B, H, W) float32 cropped magnitude images.
+    """
+    __slots__ = ('columns', 'measured', 'recon', 'f_name', 'slice_id', 'max_val', 'num_cols')
+
+    def __init__(self, columns, measured, recon, f_name, slice_id, max_val, num_cols):
+        self.columns = columns
+        self.measured = measured
+        self.recon = recon
+        self.f_name = f_name
+        self.slice_id = slice_id
+        self.max_val = max_val
+        self.num_cols = num_cols
+
+    def __iter__(self):
+        return (getattr(self, k) for k in self.__slots__)
+
+    def __getstate__(self):
+        return tuple(self)
+
+    def __setstate__(self, state):
+        for k, v in zip(self.__slots__, state):
+            setattr(self, k, v)
+
+    @property
+    def nbytes(self) -> int:
+        """Bytes of the tensors, what crosses the worker queues (in shared memory) per batch."""
+        return sum(x.element_size() * x.nelement() for x in self if isinstance(x, torch.Tensor))
+
+    def to(self, device, non_blocking: bool = False) -> 'LeanBatch':
+        return LeanBatch(*(x.to(device, non_blocking=non_blocking) if isinstance(x, torch.Tensor) else x
+                           for x in self))
+
+    def pin_memory(self) -> 'LeanBatch':
+        return LeanBatch(*(x.pin_memory() if isinstance(x, torch.Tensor) else x for x in self))
@@ -0,0 +1,223 @@
+import os
+import json
+import shutil
+import argparse
+import numpy as np
+import torch
+from os.path import join, exists
+from typing import Optional, Sequence, Tuple
+from torch.utils.data.dataset import T_co
+from torch.utils.data import Dataset
+from k_space_reconstruction.datasets.prepared import iter_prepared_volumes, prepared_fingerprint
+from k_space_reconstruction.datasets.fastmri import ReadCounter
+
+
+COLUMNS_FILE = 'kspace_columns.npy'
+TARGET_FILE = 'target.npy'
+MEAN_FILE = 'kspace_mean.npy'
+INDEX_FILE = 'index.json'
+
+
+def is_column_store(path: str) -> bool:
+    return exists(join(path, INDEX_FILE)) and exists(join(path, COLUMNS_FILE))
+
+
+def default_column_store_path(source: str) -> str:
+    return source.rstrip(os.sep) + '.cols'
+
+
+def load_column_index(path: str) -> dict:
+    with open(join(path, INDEX_FILE), 'r') as f:
+        return json.load(f)
+
+
+def column_runs(columns: np.ndarray):
+    """Splits sorted column numbers into runs of consecutive columns, one read per run."""
+    return np.split(columns, np.flatnonzero(np.diff(columns) != 1) + 1)
+
+
+def write_column_store(source: str, out_dir: str, target_shape: Sequence[int] = (320, 320), scale: float = 1e6,
+                       num_workers: Optional[int] = None) -> str:
+    """
+    Writes center cropped slices of a fastMRI dir or packed .h5 file with the k-space stored column by column,
+    so the columns of a mask are read without touching the others.
+
+    Layout of `out_dir`:
+        kspace_columns.npy: (N, W, H) complex64 cropped k-space, every column contiguous
+        target.npy: (N, H, W) float32 target magnitude images
+        kspace_mean.npy: (N,) complex128 mean of every cropped k-space slice, the reference of the noise level
+        index.json: per slice f_name, slice_id, maxval and the per volume offset table
+    """
+    shape = tuple(target_shape)
+    tmp_dir = out_dir.rstrip(os.sep) + '.tmp'
+    if exists(tmp_dir):
+        shutil.rmtree(tmp_dir)
+    os.makedirs(tmp_dir)
+    volumes, f_names, slice_ids, maxvals = [], [], [], []
+    ks_means = []
+    with open(join(tmp_dir, COLUMNS_FILE + '.raw'), 'wb') as fk, open(join(tmp_dir, TARGET_FILE + '.raw'), 'wb') as ft:
+        for f_name, k, t, maxval in iter_prepared_volumes(source, shape, scale, num_workers):
+            z = k.shape[0]
+            fk.write(np.ascontiguousarray(np.swapaxes(k, 1, 2)).tobytes())
+            ft.write(t.tobytes())
+            ks_means.append(k.mean(axis=(1, 2), dtype=np.complex128))
+            volumes.append({'f_name': f_name, 'offset': len(f_names), 'num_slices': z})
+            f_names += [f_name] * z
+            slice_ids += list(range(z))
+            maxvals += [maxval] * z
+    num_slices = len(f_names)
+    # The raw dumps become .npy files by prepending a header, nothing is held in memory
+    for name, dtype, file_shape in ((COLUMNS_FILE, np.complex64, (num_slices, shape[1], shape[0])),
+                                    (TARGET_FILE, np.float32, (num_slices,) + shape)):
+        with open(join(tmp_dir, name), 'wb') as f, open(join(tmp_dir, name + '.raw'), 'rb') as raw:
+            np.lib.format.write_array_header_1_0(f, {'descr': np.lib.format.dtype_to_descr(np.dtype(dtype)),
+                                                     'fortran_order': False, 'shape': file_shape})
+            shutil.copyfileobj(raw, f, 16 * 2 ** 20)
+        os.remove(join(tmp_dir, name + '.raw'))
+    np.save(join(tmp_dir, MEAN_FILE), np.concatenate(ks_means) if ks_means else np.zeros(0, dtype=np.complex128))
+    with open(join(tmp_dir, INDEX_FILE), 'w') as f:
+        json.dump({
+            'fingerprint': prepared_fingerprint(source, shape, scale),
+            'target_shape': list(shape),
+            'scale': scale,
+            'volumes': volumes,
+            'f_name': f_names,
+            'slice_id': slice_ids,
+            'maxval': maxvals,
+        }, f)
+    if exists(out_dir):
+        shutil.rmtree(out_dir)
+    os.replace(tmp_dir, out_dir)
+    return out_dir
+
+
+class ColumnStore(object):
+    """
+    Column reads of a store written by `write_column_store`, one pread per run of consecutive columns
+    on per-process file descriptors. Reads go around the page cache readahead of a memmap, so a
+    network filesystem only transfers the requested columns.
+    """
+
+    def __init__(self, path: str, counter: Optional[ReadCounter] = None):
+        self.path = path
+        self.counter = counter
+        columns = np.load(join(path, COLUMNS_FILE), mmap_mode='r')
+        # (N, W, H), offset of the data past the .npy header
+        self.num_slices, self.num_cols, self.height = columns.shape
+        self.data_offset = columns.offset
+        del columns
+        self.column_bytes = self.height * np.dtype(np.complex64).itemsize
+        self.ks_mean = np.load(join(path, MEAN_FILE))
+        self._targets = None
+        self._fd = None
+        self._pid = os.getpid()
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_targets'] = None
+        state['_fd'] = None
+        return state
+
+    @property
+    def shape(self) -> Tuple[int, int]:
+        return self.height, self.num_cols
+
+    def fd(self) -> int:
+        if self._fd is None or self._pid != os.getpid():
+            self._fd, self._pid = os.open(join(self.path, COLUMNS_FILE), os.O_RDONLY), os.getpid()
+        return self._fd
+
+    def read_columns(self, index: int, columns: np.ndarray) -> np.ndarray:
+        """(H, C) complex64 k-space of sorted column numbers of slice `index`."""
+        out = np.empty((len(columns), self.height), dtype=np.complex64)
+        start = self.data_offset + index * self.num_cols * self.column_bytes
+        i = 0
+        for run in column_runs(np.asarray(columns)):
+            if len(run) == 0:
+                continue
+            nbytes = len(run) * self.column_bytes
+            buf = os.pread(self.fd(), nbytes, start + int(run[0]) * self.column_bytes)
+            out[i:i + len(run)] = np.frombuffer(buf, dtype=np.complex64).reshape(len(run), self.height)
+            i += len(run)
+            if self.counter is not None:
+                self.counter.add(nbytes)
+        return out.T
+
+    def read_slice(self, index: int) -> np.ndarray:
+        """(H, W) complex64 k-space of the whole slice."""
+        return self.read_columns(index, np.arange(self.num_cols))
+
+    def target(self, index: int) -> np.ndarray:
+        if self._targets is None:
+            self._targets = np.load(join(self.path, TARGET_FILE), mmap_mode='r')
+        if self.counter is not None:
+            self.counter.add(self._targets[index].nbytes)
+        return self._targets[index]
+
+    def close(self):
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
+
+
+class FastMRIColumnDataset(Dataset):
+    """
+    Dataset reading only the k-space columns of the mask drawn for each sample, through the
+    `sample_columns` step of FastMRITransform and FastMRILeanTransform. At 4x acceleration about a quarter
+    of the k-space bytes are read, the target is still read whole. Transforms without
+    `sample_columns` get the full slice through `sample`.
+
+    `path` is either a store written by `write_column_store` or a fastMRI dir / packed .h5 file,
+    in which case the store is built next to it (or at `store_path`) and rebuilt when stale.
+    """
+
+    def __init__(self, path, transform, store_path=None, scale=1e6, num_workers=None, counter=None):
+        super(FastMRIColumnDataset, self).__init__()
+        self.transform = transform
+        if not is_column_store(path):
+            target_shape = transform.target_shape if transform else (320, 320)
+            store_path = store_path or default_column_store_path(path)
+            fingerprint = prepared_fingerprint(path, target_shape, scale)
+            if not is_column_store(store_path) or load_column_index(store_path)['fingerprint'] != fingerprint:
+                write_column_store(path, store_path, target_shape, scale, num_workers)
+            path = store_path
+        self.path = path
+        index = load_column_index(path)
+        self.volumes = index['volumes']
+        self._maxvals = index['maxval']
+        self._slices = list(zip(index['f_name'], index['slice_id']))
+        if hasattr(transform, 'add_source'):
+            # Cached validation samples are tied to the store they were computed from
+            transform.add_source(sorted(set(index['f_name'])), index['fingerprint'])
+        self.store = ColumnStore(path, counter)
+
+    def __len__(self):
+        return len(self._slices)
+
+    def __getitem__(self, index) -> T_co:
+        f_name, slice_id = self._slices[index]
+        if self.transform is None:
+            return torch.view_as_real(torch.from_numpy(np.ascontiguousarray(self.store.read_slice(index)))).permute(2, 0, 1)
+        if hasattr(self.transform, 'cached'):
+            sample = self.transform.cached(f_name, slice_id)
+            if sample is not None:
+                return sample
+        target = self.store.target(index)
+        if not hasattr(self.transform, 'sample_columns'):
+            return self.transform.sample(f_name, slice_id, self.store.read_slice(index), target, self._maxvals[index])
+        return self.transform.sample_columns(f_name, slice_id, lambda columns: self.store.read_columns(index, columns),
+                                             self.store.shape, target, self._maxvals[index],
+                                             complex(self.store.ks_mean[index]))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Write a column-major store of center cropped fastMRI slices')
+    parser.add_argument('source', help='fastMRI dir or packed .h5 file')
+    parser.add_argument('--out', default=None, help='store dir, <source>.cols by default')
+    parser.add_argument('--shape', type=int, nargs=2, default=[320, 320])
+    parser.add_argument('--scale', type=float, default=1e6)
+    parser.add_argument('--workers', type=int, default=None)
+    args = parser.parse_args()
+    out = write_column_store(args.source, args.out or default_column_store_path(args.source), args.shape, args.scale,
+                             args.workers)
+    print('%d slices -> %s' % (len(load_column_index(out)['f_name']), out))
@@ -1,18 +1,32 @@
 import os
 import re
+import zlib
+import hashlib
+import threading
 import h5py
 import cv2
 import numpy as np
 import torch
 import torch.utils.data
+import torch.distributed as dist
 import pytorch_lightning as pl
 from tqdm import tqdm
-from typing import Any, Union, List, Optional
-from os.path import isdir, join
+from typing import Any, Union, List, Optional, Sequence
+from os.path import isdir, join, basename
 from torch.utils.data.dataset import T_co
-from torch.utils.data import Dataset, DataLoader, random_split
-from k_space_reconstruction.utils.kspace import RandomMaskFunc, MaskFunc, spatial2kspace, kspace2spatial, apply_mask
-from k_space_reconstruction.utils.io import get_dir_md5hash, get_file_md5hash
+from torch.utils.data import Dataset, IterableDataset, DataLoader, DistributedSampler, random_split
+from k_space_reconstruction.utils.kspace import RandomMaskFunc, MaskFunc, apply_mask
+from k_space_reconstruction.utils.kspace import center_crop_kspace, ifft2c, fft2c_, ifft2c_
+from k_space_reconstruction.utils.io import H5FilePool, get_file_stat_hash
+from k_space_reconstruction.datasets.index import get_index
+from k_space_reconstruction.datasets.sampler import VolumeLocalitySampler
+from k_space_reconstruction.datasets.shared import FastMRISharedDataset
+from k_space_reconstruction.datasets.loader import BatchPrefetcher, ThreadPoolLoader
+from k_space_reconstruction.datasets.batch import ReconstructionBatch, BatchCollator, LeanBatch
+from k_space_reconstruction.datasets.stream import FastMRIStreamDataset
+from k_space_reconstruction.datasets.memmap import FastMRIMemmapDataset
+from k_space_reconstruction.datasets.autotune import loader_kwargs, resolve_loader_config
+from k_space_reconstruction.utils.threads import CoreBudget
 
 
 class FastMRITransformC(object):
@@ -63,14 +77,14 @@ class FastMRITransformC(object):
         
         #-------------------------------------------------
 
+    def crop(self, k_space: np.ndarray):
+        return center_crop_kspace(k_space, self.target_shape)
+
     def __call__(self, f_name: str, slice_id: str, k_space: np.ndarray, max_val: float):
-        recon = kspace2spatial(k_space)
-        xs = (k_space.shape[0] - self.target_shape[0]) // 2
-        ys = (k_space.shape[1] - self.target_shape[1]) // 2
-        xt = xs + self.target_shape[0]
-        yt = ys + self.target_shape[1]
-        recon = recon[xs:xt, ys:yt]
-        k_space = spatial2kspace(recon)
+        k_space, recon = self.crop(k_space)
+        return self.sample(f_name, slice_id, k_space, recon, max_val)
+
+    def sample(self, f_name: str, slice_id: str, k_space: np.ndarray, recon: np.ndarray, max_val: float):
         k_space = self.add_noise(k_space)
         if self.mask_f:
             k_space, mask = apply_mask(k_space, self.mask_f)
@@ -135,18 +149,75 @@ class FastMRITransform(object):
             ks = ks.reshape(shape)
             return ks
 
+    def crop(self, k_space: np.ndarray):
+        return center_crop_kspace(k_space, self.target_shape)
+
     def __call__(self, f_name: str, slice_id: str, k_space: np.ndarray, max_val: float):
-        recon = kspace2spatial(k_space)
-        xs = (k_space.shape[0] - self.target_shape[0]) // 2
-        ys = (k_space.shape[1] - self.target_shape[1]) // 2
-        xt = xs + self.target_shape[0]
-        yt = ys + self.target_shape[1]
-        recon = recon[xs:xt, ys:yt]
-        k_space = spatial2kspace(recon)
+        k_space, recon = self.crop(k_space)
+        return self.sample(f_name, slice_id, k_space, recon, max_val)
+
+    def sample(self, f_name: str, slice_id: str, k_space: np.ndarray, recon: np.ndarray, max_val: float):
         k_space = self.add_noise(k_space)
         if self.mask_f:
             k_space, mask = apply_mask(k_space, self.mask_f)
-        sampled_image = kspace2spatial(k_space)
+        return self.finalize(f_name, slice_id, k_space, mask, recon, max_val)
+
+    def mask_columns(self, shape) -> np.ndarray:
+        """Sampled column numbers of a new mask for (H, W) slices."""
+        if not self.mask_f:
+            return np.arange(shape[-1])
+        return np.flatnonzero(self.mask_f(shape, None).reshape(-1))
+
+    def add_noise_columns(self, measured: np.ndarray, columns: np.ndarray, shape, ks_mean: complex) -> np.ndarray:
+        """add_noise of a (H, W) slice restricted to its (H, C) sampled columns, `ks_mean` is the slice mean."""
+        if self.noise_type == 'none':
+            return measured
+        elif self.noise_type == 'normal':
+            return measured + np.random.normal(size=measured.shape) * ks_mean * self.noise_level
+        elif self.noise_type == 'poisson':
+            return measured + np.random.poisson(size=measured.shape) * ks_mean * self.noise_level
+        elif self.noise_type == 'salt':
+            return self.add_salt_columns(measured, columns, shape, ks_mean * self.noise_level)
+        elif self.noise_type == 'normal_and_salt':
+            measured = measured + np.random.normal(size=measured.shape) * ks_mean * 100
+            return self.add_salt_columns(measured, columns, shape, ks_mean * 5e4)
+
+    @staticmethod
+    def add_salt_columns(measured: np.ndarray, columns: np.ndarray, shape, value: complex, num_points=10):
+        # Points are drawn over the whole slice, the ones in unsampled columns are masked out anyway
+        rows, cols = np.divmod(np.random.randint(low=0, high=shape[0] * shape[1], size=num_points), shape[1])
+        pos = np.minimum(np.searchsorted(columns, cols), len(columns) - 1)
+        hit = columns[pos] == cols
+        measured = measured.astype(np.complex128)
+        measured[rows[hit], pos[hit]] = value
+        return measured
+
+    def sample_columns(self, f_name: str, slice_id: str, read_columns, shape, recon: np.ndarray, max_val: float,
+                       ks_mean: complex):
+        """
+        sample() drawing the mask first and reading only the sampled k-space columns.
+
+        Args:
+            read_columns: Callable returning the (H, C) k-space of sorted column numbers.
+            shape: (H, W) of the cropped k-space.
+            ks_mean: Mean of the whole cropped k-space slice, the noise level is relative to it.
+        """
+        columns = self.mask_columns(shape)
+        mask = np.zeros((1, shape[1]), dtype=np.float32)
+        mask[0, columns] = 1.0
+        k_space = self.read_masked(read_columns, columns, shape, ks_mean)
+        return self.finalize(f_name, slice_id, k_space, mask, recon, max_val)
+
+    def read_masked(self, read_columns, columns: np.ndarray, shape, ks_mean: complex) -> np.ndarray:
+        """Noisy zero-filled (H, W) k-space of the sampled `columns`."""
+        measured = self.add_noise_columns(read_columns(columns), columns, shape, ks_mean)
+        k_space = np.zeros(shape, dtype=measured.dtype)
+        k_space[:, columns] = measured
+        return k_space
+
+    def finalize(self, f_name: str, slice_id: str, k_space: np.ndarray, mask: np.ndarray, recon: np.ndarray,
+                 max_val: float):
+        sampled_image = np.abs(ifft2c(k_space))
         sampled_image, mean, std = self.normalize(sampled_image)
         target = (recon - mean) / (std + 1e-11)
 
@@ -160,83 +231,552 @@ class FastMRITransform(object):
         return k_space, mask, target, sampled_image, mean, std, f_name, slice_id, max_val
 
 
+class FastMRIInplaceTransform(FastMRITransform):
+    """
+    FastMRITransform producing the same 9-tuple with a handful of allocations per sample: the FFTs,
+    the noise, the mask and the normalization run in place on buffers owned by the transform, so
+    every DataLoader worker and every ThreadPoolLoader thread reuses its own copy. Only the returned
+    arrays are new, the k_space channels are a view of complex64 memory (torch.view_as_real), not
+    a stacked copy.
+    Slices with odd sizes fall back to the FastMRITransform code path.
+    """
+
+    def __init__(self, mask_f: MaskFunc, target_shape=(320, 320), noise_level=0.0, noise_type='none'):
+        super(FastMRIInplaceTransform, self).__init__(mask_f, target_shape, noise_level, noise_type)
+        self._scratch = threading.local()
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state['_scratch']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._scratch = threading.local()
+
+    def scratch(self, name: str, shape, dtype) -> np.ndarray:
+        buffers = self._scratch.__dict__
+        buf = buffers.get(name)
+        if buf is None or buf.shape != tuple(shape) or buf.dtype != dtype:
+            buf = buffers[name] = np.empty(shape, dtype=dtype)
+        return buf
+
+    def _inplace(self, shape) -> bool:
+        return not (shape[0] % 2 or shape[1] % 2 or self.target_shape[0] % 2 or self.target_shape[1] % 2)
+
+    def _crop_into(self, k_space: np.ndarray, ks: np.ndarray, recon: np.ndarray):
+        work = self.scratch('full', k_space.shape, np.complex64)
+        np.copyto(work, k_space)
+        ifft2c_(work)
+        xs = (k_space.shape[0] - self.target_shape[0]) // 2
+        ys = (k_space.shape[1] - self.target_shape[1]) // 2
+        np.abs(work[xs:xs + self.target_shape[0], ys:ys + self.target_shape[1]], out=recon)
+        np.copyto(ks, recon)
+        fft2c_(ks)
+
+    def crop(self, k_space: np.ndarray):
+        if not self._inplace(k_space.shape):
+            return super(FastMRIInplaceTransform, self).crop(k_space)
+        ks = np.empty(self.target_shape, dtype=np.complex64)
+        recon = np.empty(self.target_shape, dtype=np.float32)
+        self._crop_into(k_space, ks, recon)
+        return ks, recon
+
+    def __call__(self, f_name: str, slice_id: str, k_space: np.ndarray, max_val: float):
+        if not self._inplace(k_space.shape):
+            return super(FastMRIInplaceTransform, self).__call__(f_name, slice_id, k_space, max_val)
+        ks = self.scratch('k_space', self.target_shape, np.complex64)
+        recon = self.scratch('recon', self.target_shape, np.float32)
+        self._crop_into(k_space, ks, recon)
+        return self.sample(f_name, slice_id, ks, recon, max_val)
+
+    def add_noise_(self, ks: np.ndarray):
+        if self.noise_type == 'none':
+            return
+        flat = ks.reshape(-1)
+        if self.noise_type in ('normal', 'poisson'):
+            noise = np.random.normal(size=ks.shape) if self.noise_type == 'normal' else np.random.poisson(size=ks.shape)
+            ks += noise * (ks.mean() * self.noise_level)
+        elif self.noise_type == 'salt':
+            i = np.random.randint(low=0, high=ks.size, size=10)
+            flat[i] = ks.mean() * self.noise_level
+        elif self.noise_type == 'normal_and_salt':
+            ks_mean = ks.mean()
+            ks += np.random.normal(size=ks.shape) * (ks_mean * 100)
+            i = np.random.randint(low=0, high=ks.size, size=10)
+            flat[i] = ks_mean * 5e4
+
+    def sample(self, f_name: str, slice_id: str, k_space: np.ndarray, recon: np.ndarray, max_val: float):
+        if not self._inplace(k_space.shape):
+            return super(FastMRIInplaceTransform, self).sample(f_name, slice_id, k_space, recon, max_val)
+        # Inputs may be read-only store views or scratch buffers, the returned k-space is a copy
+        ks = np.array(k_space, dtype=np.complex64)
+        self.add_noise_(ks)
+        mask = self.mask_f(ks.shape, None)
+        np.multiply(ks, mask, out=ks)
+        ks += 0.0
+
+        work = self.scratch('image', ks.shape, np.complex64)
+        np.copyto(work, ks)
+        ifft2c_(work)
+        image = np.abs(work, out=np.empty(ks.shape, dtype=np.float32))
+        mean = image.mean(dtype=np.float64)
+        image -= mean
+        squares = np.multiply(image, image, out=self.scratch('squares', ks.shape, np.float32))
+        std = np.sqrt(squares.mean(dtype=np.float64))
+        image /= std + 1e-11
+        target = np.subtract(recon, mean, out=np.empty(ks.shape, dtype=np.float32))
+        target /= std + 1e-11
+
+        return (torch.view_as_real(torch.from_numpy(ks)).permute(2, 0, 1),
+                torch.as_tensor(mask, dtype=torch.float).unsqueeze(0),
+                torch.from_numpy(target).unsqueeze(0),
+                torch.from_numpy(image).unsqueeze(0),
+                torch.tensor(mean, dtype=torch.float).view(1, 1, 1),
+                torch.tensor(std, dtype=torch.float).view(1, 1, 1),
+                f_name, slice_id, max_val)
+
+
+class MaskBank(object):
+    """
+    Seeded masks keyed by (volume, slice, acceleration), a slice gets the same mask in every epoch.
+
+    Args:
+        mask_f: Mask function the masks are drawn from.
+        seed: Base seed of the bank.
+    """
+
+    def __init__(self, mask_f: MaskFunc, seed=0):
+        self.mask_f = mask_f
+        self.seed = seed
+        self._masks = {}
+
+    def slice_seed(self, f_name: str, slice_id):
+        return self.seed, zlib.crc32(('%s:%s' % (basename(f_name), slice_id)).encode())
+
+    def get(self, f_name: str, slice_id, shape, acceleration=None) -> np.ndarray:
+        seed = self.slice_seed(f_name, slice_id)
+        if acceleration is None:
+            # Deterministic choice among the accelerations of mask_f
+            choice = seed[1] % len(self.mask_f.accelerations)
+        else:
+            choice = list(self.mask_f.accelerations).index(acceleration)
+        pair = (self.mask_f.center_fractions[choice], self.mask_f.accelerations[choice])
+        key = (f_name, slice_id, pair[1])
+        if key not in self._masks:
+            self._masks[key] = self.mask_f.batch(shape, seeds=[seed], pairs=[pair])[0, 0]
+        return self._masks[key]
+
+
+# Bump when the validation samples change, .pt files of older versions in a cache_dir are then ignored
+VAL_CACHE_VERSION = 1
+
+
+class FastMRIValTransform(FastMRITransform):
+    """
+    Validation transform, masks come from a MaskBank so every epoch sees the same inputs.
+
+    Without noise the samples are deterministic and memoized, in RAM or as .pt files in `cache_dir`,
+    so later epochs skip the slice read, crop, FFTs and normalization. The RAM cache lives in the process
+    that runs the transform, use `cache_dir` or persistent DataLoader workers with num_workers > 0.
+    Datasets tie the .pt files to the stats of their source files through `add_source`.
+    """
+
+    def __init__(self, mask_f: MaskFunc, target_shape=(320, 320), noise_level=0.0, noise_type='none',
+                 seed=0, acceleration=None, cache_dir=None):
+        super(FastMRIValTransform, self).__init__(mask_f, target_shape, noise_level, noise_type)
+        self.mask_bank = MaskBank(mask_f, seed)
+        self.acceleration = acceleration
+        self.cache_dir = cache_dir
+        self._cache = {}
+        self._sources = {}
+        if cache_dir is not None:
+            os.makedirs(cache_dir, exist_ok=True)
+
+    @property
+    def memoize(self) -> bool:
+        return self.noise_type == 'none'
+
+    def add_source(self, f_names: Sequence[str], fingerprint: str):
+        """Ties the cached samples of `f_names` to the fingerprint of the file they are read from."""
+        for f_name in f_names:
+            self._sources[f_name] = fingerprint
+
+    def _cache_file(self, f_name: str, slice_id) -> str:
+        key = (VAL_CACHE_VERSION, self._sources.get(f_name), basename(f_name), slice_id, self.acceleration,
+               tuple(self.target_shape), self.mask_bank.seed, tuple(self.mask_f.center_fractions),
+               tuple(self.mask_f.accelerations))
+        return join(self.cache_dir, hashlib.md5(repr(key).encode()).hexdigest() + '.pt')
+
+    def _cache_get(self, f_name: str, slice_id):
+        if not self.memoize:
+            return None
+        sample = self._cache.get((f_name, slice_id))
+        if sample is None and self.cache_dir is not None and os.path.exists(self._cache_file(f_name, slice_id)):
+            sample = torch.load(self._cache_file(f_name, slice_id))
+            self._cache[(f_name, slice_id)] = sample
+        return sample
+
+    def _cache_put(self, f_name: str, slice_id, sample):
+        if not self.memoize:
+            return
+        self._cache[(f_name, slice_id)] = sample
+        if self.cache_dir is not None:
+            tmp_path = self._cache_file(f_name, slice_id) + '.tmp%d' % os.getpid()
+            torch.save(sample, tmp_path)
+            os.replace(tmp_path, self._cache_file(f_name, slice_id))
+
+    def cached(self, f_name: str, slice_id):
+        """Memoized sample or None, datasets ask before reading the slice."""
+        return self._cache_get(f_name, slice_id)
+
+    def __call__(self, f_name: str, slice_id: str, k_space: np.ndarray, max_val: float):
+        sample = self._cache_get(f_name, slice_id)
+        if sample is None:
+            sample = super(FastMRIValTransform, self).__call__(f_name, slice_id, k_space, max_val)
+        return sample
+
+    def sample(self, f_name: str, slice_id: str, k_space: np.ndarray, recon: np.ndarray, max_val: float):
+        sample = self._cache_get(f_name, slice_id)
+        if sample is not None:
+            return sample
+        k_space = self.add_noise(k_space)
+        mask = self.mask_bank.get(f_name, slice_id, k_space.shape, self.acceleration)
+        k_space = k_space * mask + 0.0
+        sample = self.finalize(f_name, slice_id, k_space, mask, recon, max_val)
+        self._cache_put(f_name, slice_id, sample)
+        return sample
+
+    def sample_columns(self, f_name: str, slice_id: str, read_columns, shape, recon: np.ndarray, max_val: float,
+                       ks_mean: complex):
+        sample = self._cache_get(f_name, slice_id)
+        if sample is not None:
+            return sample
+        mask = self.mask_bank.get(f_name, slice_id, shape, self.acceleration)
+        k_space = self.read_masked(read_columns, np.flatnonzero(mask.reshape(-1)), shape, ks_mean)
+        sample = self.finalize(f_name, slice_id, k_space, mask, recon, max_val)
+        self._cache_put(f_name, slice_id, sample)
+        return sample
+
+
+class FastMRIBatchTransform(FastMRITransform):
+    """
+    FastMRITransform with the random stages (noise, mask, zero-filled IFFT, normalization, packing)
+    vectorized over a whole batch. Per sample only the deterministic crop runs, the rest runs
+    in `collate`, which returns the ReconstructionBatch BatchCollator builds from FastMRITransform:
+
+        transform = FastMRIBatchTransform(RandomMaskFunc([0.08], [4]))
+        dataset = FastMRIh5Dataset(hf_path, transform)
+        loader = DataLoader(dataset, batch_size=64, num_workers=12, collate_fn=transform.collate)
+
+    To run the stages in the main process (e.g. on GPU) use `collate_fn=transform.stack` and call
+    `transform.batch(*batch)` on the moved tensors.
+    """
+
+    def sample(self, f_name: str, slice_id: str, k_space: np.ndarray, recon: np.ndarray, max_val: float):
+        return f_name, slice_id, k_space, recon, max_val
+
+    def sample_columns(self, f_name: str, slice_id: str, read_columns, shape, recon: np.ndarray, max_val: float,
+                       ks_mean: complex):
+        # The mask is drawn per batch in `collate`, so every column is read
+        return self.sample(f_name, slice_id, read_columns(np.arange(shape[1])), recon, max_val)
+
+    @staticmethod
+    def stack(samples):
+        f_names, slice_ids, k_space, recon, max_vals = zip(*samples)
+        return (list(f_names), torch.as_tensor(slice_ids), torch.as_tensor(np.stack(k_space)),
+                torch.as_tensor(np.stack(recon)), torch.as_tensor(max_vals, dtype=torch.float64))
+
+    def collate(self, samples):
+        return self.batch(*self.stack(samples))
+
+    def add_noise_batch(self, ks: torch.Tensor) -> torch.Tensor:
+        if self.noise_type == 'none':
+            return ks
+        ks_mean = ks.mean(dim=(-2, -1), keepdim=True)
+        if self.noise_type == 'normal':
+            return ks + torch.randn(ks.shape, dtype=ks.real.dtype, device=ks.device) * ks_mean * self.noise_level
+        elif self.noise_type == 'poisson':
+            ones = torch.ones(ks.shape, dtype=ks.real.dtype, device=ks.device)
+            return ks + torch.poisson(ones) * ks_mean * self.noise_level
+        elif self.noise_type == 'salt':
+            return self.add_salt_batch(ks, ks_mean * self.noise_level)
+        elif self.noise_type == 'normal_and_salt':
+            normal_noise_lvl = 100
+            salt_noise_lvl = 5e4
+            ks = ks + torch.randn(ks.shape, dtype=ks.real.dtype, device=ks.device) * ks_mean * normal_noise_lvl
+            return self.add_salt_batch(ks, ks_mean * salt_noise_lvl)
+
+    @staticmethod
+    def add_salt_batch(ks: torch.Tensor, value: torch.Tensor, num_points=10) -> torch.Tensor:
+        shape = ks.shape
+        ks = ks.reshape(shape[0], -1)
+        i = torch.randint(0, ks.shape[1], (shape[0], num_points), device=ks.device)
+        ks = ks.scatter(1, i, value.reshape(shape[0], 1).expand(-1, num_points))
+        return ks.reshape(shape)
+
+    def mask_batch(self, num: int, num_cols: int) -> torch.Tensor:
+        if not self.mask_f:
+            return torch.ones(num, num_cols)
+        return torch.as_tensor(self.mask_f.batch((1, num_cols), num)).reshape(num, num_cols)
+
+    def batch(self, f_names: Sequence[str], slice_ids: torch.Tensor, k_space: torch.Tensor, recon: torch.Tensor,
+              max_vals: torch.Tensor):
+        """
+        Args:
+            f_names: B volume names.
+            slice_ids: (B,) slice ids.
+            k_space: (B, H, W) complex cropped k-space.
+            recon: (B, H, W) cropped magnitude images.
+            max_vals: (B,) volume maxval.
+
+        Returns:
+            k_space, mask, target, sampled_image, mean, std, f_name, slice_id, max_val
+        """
+        k_space = self.add_noise_batch(k_space)
+        mask = self.mask_batch(k_space.shape[0], k_space.shape[-1]).to(k_space.device)
+        k_space = k_space * mask[:, None, :] + 0.0
+        return self.finalize_batch(f_names, slice_ids, k_space, mask, recon, max_vals)
+
+    def finalize_batch(self, f_names: Sequence[str], slice_ids: torch.Tensor, k_space: torch.Tensor,
+                       mask: torch.Tensor, recon: torch.Tensor, max_vals: torch.Tensor):
+        """Zero-filled image, normalization and packing of (B, H, W) masked k-space with (B, W) masks."""
+        sampled_image = torch.fft.fftshift(k_space, dim=(-2, -1))
+        sampled_image = torch.fft.ifftn(sampled_image, dim=(-2, -1), norm='ortho')
+        sampled_image = torch.fft.ifftshift(sampled_image, dim=(-2, -1)).abs()
+        mean = sampled_image.mean(dim=(-2, -1), keepdim=True)
+        std = sampled_image.std(dim=(-2, -1), keepdim=True, unbiased=False)
+        sampled_image = (sampled_image - mean) / (std + 1e-11)
+        target = (recon - mean) / (std + 1e-11)
+
+        k_space = torch.stack((k_space.real, k_space.imag), dim=1).float()
+        mask = mask[:, None, None, :].float()
+        target = target.unsqueeze(1).float()
+        sampled_image = sampled_image.unsqueeze(1).float()
+        mean = mean.unsqueeze(1).float()
+        std = std.unsqueeze(1).float()
+
+        return ReconstructionBatch(k_space, mask, target, sampled_image, mean, std, f_names, slice_ids, max_vals)
+
+
+class FastMRILeanTransform(FastMRIBatchTransform):
+    """
+    Noise and mask run per sample like FastMRITransform, but a sample only keeps the sampled columns
+    of the k-space, the target is left unnormalized and the zero-filled image is not computed:
+
+        f_name, slice_id, columns, measured, recon, max_val, num_cols
+
+    `collate` pads the column lists into a LeanBatch, so with 4x masks the workers hand over about
+    a quarter of the k-space and no image. `expand` rebuilds the dense zero-filled k-space, mask,
+    image and normalization in the training process (on the GPU after the batch transfer), the
+    data modules call it from `on_after_batch_transfer`:
+
+        transform = FastMRILeanTransform(RandomMaskFunc([0.08], [4]))
+        loader = DataLoader(dataset, batch_size=8, num_workers=12, collate_fn=transform.collate)
+        for batch in loader:
+            ks, mask, y, x, mean, std, f_name, slice_id, max_val = transform.expand(batch.to('cuda'))
+    """
+
+    def sample(self, f_name: str, slice_id: str, k_space: np.ndarray, recon: np.ndarray, max_val: float):
+        k_space = self.add_noise(k_space)
+        columns = self.mask_columns(k_space.shape)
+        return self.lean_sample(f_name, slice_id, columns, k_space[:, columns], recon, max_val, k_space.shape[-1])
+
+    def sample_columns(self, f_name: str, slice_id: str, read_columns, shape, recon: np.ndarray, max_val: float,
+                       ks_mean: complex):
+        columns = self.mask_columns(shape)
+        measured = self.add_noise_columns(read_columns(columns), columns, shape, ks_mean)
+        return self.lean_sample(f_name, slice_id, columns, measured, recon, max_val, shape[-1])
+
+    @staticmethod
+    def lean_sample(f_name, slice_id, columns, measured, recon, max_val, num_cols):
+        measured = np.ascontiguousarray(measured, dtype=np.complex64)
+        return f_name, slice_id, columns, measured, np.asarray(recon, dtype=np.float32), max_val, num_cols
+
+    @staticmethod
+    def collate(samples) -> LeanBatch:
+        f_names, slice_ids, columns, measured, recon, max_vals, num_cols = zip(*samples)
+        if len(set(num_cols)) != 1:
+            raise ValueError('Samples of a batch must have the same number of columns, got %s' % set(num_cols))
+        n, h, c = len(samples), measured[0].shape[0], max(len(cols) for cols in columns)
+        padded_columns = np.full((n, c), num_cols[0], dtype=np.int64)
+        padded = np.zeros((n, h, c), dtype=np.complex64)
+        for i, (cols, ks) in enumerate(zip(columns, measured)):
+            padded_columns[i, :len(cols)] = cols
+            padded[i, :, :len(cols)] = ks
+        return LeanBatch(torch.from_numpy(padded_columns), torch.from_numpy(padded), torch.as_tensor(np.stack(recon)),
+                         list(f_names), torch.as_tensor(slice_ids),
+                         torch.as_tensor(max_vals, dtype=torch.float64), num_cols[0])
+
+    def expand(self, batch: LeanBatch) -> ReconstructionBatch:
+        """Dense ReconstructionBatch of a LeanBatch, on the device of its tensors."""
+        n, h, c = batch.measured.shape
+        # The padding column num_cols collects the zeros of short rows and is dropped
+        columns = batch.columns.unsqueeze(1).expand(n, h, c)
+        k_space = batch.measured.new_zeros((n, h, batch.num_cols + 1))
+        k_space = k_space.scatter(2, columns, batch.measured)[..., :batch.num_cols]
+        mask = batch.recon.new_zeros((n, batch.num_cols + 1))
+        mask = mask.scatter(1, batch.columns, 1.0)[:, :batch.num_cols]
+        return self.finalize_batch(batch.f_name, batch.slice_id, k_space, mask, batch.recon, batch.max_val)
+
+
+class ReadCounter(object):
+    """K-space bytes requested from HDF5, summed over the dataset and its DataLoader workers."""
+    MAX_WORKERS = 256
+
+    def __init__(self):
+        # One shared slot per process, so workers never race on the same counter
+        self._bytes = torch.zeros(self.MAX_WORKERS + 1, dtype=torch.int64).share_memory_()
+        # Threads of a process (ThreadPoolLoader) share its slot
+        self._lock = threading.Lock()
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state['_lock']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+    def add(self, nbytes: int):
+        info = torch.utils.data.get_worker_info()
+        slot = 0 if info is None else info.id % self.MAX_WORKERS + 1
+        with self._lock:
+            self._bytes[slot] += nbytes
+
+    def reset(self):
+        self._bytes.zero_()
+
+    @property
+    def value(self) -> int:
+        return int(self._bytes.sum())
+
+
+def add_transform_source(transform, f_names: Sequence[str], fp: str):
+    if hasattr(transform, 'add_source'):
+        transform.add_source(f_names, get_file_stat_hash(fp))
+
+
+def cached_sample(transform, f_name: str, slice_id):
+    """Sample the transform memoized (FastMRIValTransform), None when the slice has to be read."""
+    cached = getattr(transform, 'cached', None)
+    return cached(f_name, slice_id) if cached is not None else None
+
+
+def read_kspace_slice(dset: h5py.Dataset, slice_id: int, scale: float = 1.0, counter: Optional[ReadCounter] = None) -> np.ndarray:
+    """Reads a single (H, W) slice of a (Z, H, W) k-space volume through a hyperslab selection."""
+    ks = np.empty(dset.shape[1:], dtype=dset.dtype)
+    dset.read_direct(ks, np.s_[slice_id])
+    if counter is not None:
+        counter.add(ks.nbytes)
+    if scale != 1.0:
+        ks *= scale
+    return ks
+
+
 class FastMRIDataset(Dataset):
+    SCALE = 1e6
 
-    def __init__(self, dir_path, transform):
+    def __init__(self, dir_path, transform, index_path=None, num_workers=None, max_open_files=16):
         super(FastMRIDataset, self).__init__()
         self.dir = dir_path
         self.transform = transform
+        self.index = get_index(dir_path, index_path, num_workers)
+        self.bytes_read = ReadCounter()
+        self.files = H5FilePool(max_open_files)
         self._slices = []
         for f in sorted(os.listdir(self.dir)):
-            hf = h5py.File(join(self.dir, f))
-            for iz in range(hf['kspace'].shape[0]):
+            add_transform_source(transform, [join(self.dir, f)], join(self.dir, f))
+            for iz in range(self.index[f]['num_slices']):
                 self._slices += [(join(self.dir, f), iz)]
-            hf.close()
 
     def __len__(self):
         return len(self._slices)
 
     def __getitem__(self, index) -> T_co:
         fp, slice_id = self._slices[index]
-        hf = h5py.File(fp)
-        ks = hf['kspace'][:]
-        ks = ks * 1e6
-        maxval = np.stack([kspace2spatial(k) for k in ks]).max()
-        # maxval = hf.attrs['max']
-        # target = hf['reconstruction_esc'][slice_id]
+        sample = cached_sample(self.transform, fp, slice_id)
+        if sample is not None:
+            return sample
+        hf = self.files.get(fp)
         if self.transform:
-            return self.transform(fp, slice_id, ks[slice_id], maxval)
+            ks = read_kspace_slice(hf['kspace'], slice_id, self.SCALE, self.bytes_read)
+            maxval = self.index[basename(fp)]['maxval'] * self.SCALE
+            # target = hf['reconstruction_esc'][slice_id]
+            return self.transform(fp, slice_id, ks, maxval)
         else:
+            ks = hf['kspace'][:]
+            self.bytes_read.add(ks.nbytes)
+            ks = ks * self.SCALE
             return torch.as_tensor(np.stack((ks.real, ks.imag)), dtype=torch.float)
 
 
 class FastMRIh5Dataset(Dataset):
+    SCALE = 1e6
 
-    def __init__(self, hf_path, transform):
+    def __init__(self, hf_path, transform, index_path=None, num_workers=None):
         super(FastMRIh5Dataset, self).__init__()
         self.hf_path = hf_path
-        self.hf = h5py.File(hf_path)
+        self.index = get_index(hf_path, index_path, num_workers)
+        self.files = H5FilePool(max_open=1)
         self.transform = transform
+        self.bytes_read = ReadCounter()
         self._slices = []
-        for f in sorted(list(self.hf.keys())):
-            for iz in range(self.hf[f].shape[0]):
+        for f in sorted(list(self.index.keys())):
+            for iz in range(self.index[f]['num_slices']):
                 self._slices += [(f, iz)]
+        add_transform_source(transform, list(self.index.keys()), hf_path)
+
+    @property
+    def hf(self) -> h5py.File:
+        return self.files.get(self.hf_path)
 
     def __len__(self):
         return len(self._slices)
 
     def __getitem__(self, index) -> T_co:
         key, slice_id = self._slices[index]
-        ks = self.hf[key][:]
-        ks = ks * 1e6
-        maxval = np.stack([kspace2spatial(k) for k in ks]).max()
+        sample = cached_sample(self.transform, key, slice_id)
+        if sample is not None:
+            return sample
         if self.transform:
-            return self.transform(key, slice_id, ks[slice_id], maxval)
+            ks = read_kspace_slice(self.hf[key], slice_id, self.SCALE, self.bytes_read)
+            maxval = self.index[key]['maxval'] * self.SCALE
+            return self.transform(key, slice_id, ks, maxval)
         else:
+            ks = self.hf[key][:]
+            self.bytes_read.add(ks.nbytes)
+            ks = ks * self.SCALE
             return torch.as_tensor(np.stack((ks.real, ks.imag)), dtype=torch.float)
 
 
 class LegacyFastMRIh5Dataset(Dataset):
 
-    def __init__(self, hf_path, transform):
+    def __init__(self, hf_path, transform, index_path=None, num_workers=None):
         super(LegacyFastMRIh5Dataset, self).__init__()
         self.hf_path = hf_path
-        self.hf = h5py.File(hf_path)
+        self.index = get_index(hf_path, index_path, num_workers)
+        self.files = H5FilePool(max_open=1)
         self.transform = transform
         self._slices = []
-        for f in sorted(list(self.hf.keys())):
-            for iz in range(self.hf[f].shape[0]):
+        for f in sorted(list(self.index.keys())):
+            for iz in range(self.index[f]['num_slices']):
                 self._slices += [(f, iz)]
 
+    @property
+    def hf(self) -> h5py.File:
+        return self.files.get(self.hf_path)
+
     def __len__(self):
         return len(self._slices)
 
     def __getitem__(self, index) -> T_co:
         key, slice_id = self._slices[index]
         if self.transform:
-            ks = self.hf[key][:]
-            maxval = np.stack([kspace2spatial(k) for k in ks]).max()
-            return self.transform(key, slice_id, ks[slice_id], maxval)
+            ks = self.hf[key][slice_id]
+            maxval = self.index[key]['maxval']
+            return self.transform(key, slice_id, ks, maxval)
         else:
             ks = self.hf[key][slice_id]
             xs = (ks.shape[0] - 640) // 2
@@ -253,13 +793,35 @@ class PlFastMRIkneeDataModule(pl.LightningDataModule):
     DIR_TRAIN_HASH = '00651c3286630fe70d8aaaa119564c67'
     DIR_VAL_HASH = '9562281616da52c6aac67bb6b9132053'
 
-    def __init__(self, root_dir, transform, batch_size=1, num_workers=0, prefetch_factor=2, random_seed=42, train_val_split=0.2):
+    def __init__(self, root_dir, transform, batch_size=1, num_workers=0, prefetch_factor=2, random_seed=42, train_val_split=0.2,
+                 locality_window=None, in_memory=False, prefetch_to_device=False, stream_buffer=None,
+                 persistent_workers=False, thread_budget=False, loader_threads=None, memmap=False,
+                 reuse_buffers=False):
         super(PlFastMRIkneeDataModule, self).__init__()
         self.root_dir = root_dir
         self.transform = transform
+        # 'auto' takes the value datasets/autotune.py found for the train dataset on this machine
         self.batch_size = batch_size
         self.num_workers = num_workers
         self.prefetch_factor = prefetch_factor
+        self.persistent_workers = persistent_workers
+        # Split the cores between the model and the workers, see utils/threads.py
+        self.thread_budget = thread_budget
+        self.core_budget = None
+        # Load map-style datasets on this many threads of the training process instead of worker processes
+        self.loader_threads = loader_threads
+        # Shuffle slices within windows of this many volumes instead of over the whole train set
+        self.locality_window = locality_window
+        # Load cropped slices once into shared memory at setup, workers read them without copies
+        self.in_memory = in_memory
+        # Serve cropped slices from a memory-mapped store next to every dataset, built on first use
+        self.memmap = memmap
+        # Stage the next batches on the model device from a background thread
+        self.prefetch_to_device = prefetch_to_device
+        # Stream whole train volumes through a shuffle buffer of this many slices per worker
+        self.stream_buffer = stream_buffer
+        # Batches collated in this process (no workers or loader threads) reuse a ring of buffers
+        self.reuse_buffers = reuse_buffers
         self._train = None
         self._val = None
         self._test = None
@@ -267,30 +829,98 @@ class PlFastMRIkneeDataModule(pl.LightningDataModule):
 
     # def prepare_data(self, *args, **kwargs):
     #     if os.path.exists(join(self.root_dir, self.DIR_NAME)) and os.path.isdir(join(self.root_dir, self.DIR_NAME)):
-    #         if not get_dir_md5hash(join(self.root_dir, self.DIR_NAME, self.DIR_TRAIN)) == self.DIR_TRAIN_HASH:
+    #         if not get_dir_md5hash_cached(join(self.root_dir, self.DIR_NAME, self.DIR_TRAIN)) == self.DIR_TRAIN_HASH:
     #             raise ValueError('Wrong checksum, delete %s dir' % self.root_dir)
-    #         if not get_dir_md5hash(join(self.root_dir, self.DIR_NAME, self.DIR_TEST)) == self.DIR_TEST_HASH:
+    #         if not get_dir_md5hash_cached(join(self.root_dir, self.DIR_NAME, self.DIR_TEST)) == self.DIR_TEST_HASH:
     #             raise ValueError('Wrong checksum, delete %s dir' % self.root_dir)
     #         return True
     #     raise ValueError('Dir not exist')
 
+    def dataset(self, path: str, dataset_cls=None) -> Dataset:
+        if self.in_memory:
+            return FastMRISharedDataset(path, self.transform)
+        if self.memmap:
+            return FastMRIMemmapDataset(path, self.transform)
+        return (dataset_cls or FastMRIDataset)(path, self.transform)
+
+    def train_dataset(self, path: str, dataset_cls=None) -> Dataset:
+        if self.stream_buffer:
+            return FastMRIStreamDataset(path, self.transform, self.stream_buffer, seed=self.random_seed)
+        return self.dataset(path, dataset_cls)
+
     def setup(self, stage: Optional[str] = None):
-        self._train = FastMRIDataset(join(self.root_dir, self.DIR_NAME, self.DIR_TRAIN), self.transform)
-        self._val = FastMRIDataset(join(self.root_dir, self.DIR_NAME, self.DIR_VAL), self.transform)
+        self._train = self.train_dataset(join(self.root_dir, self.DIR_NAME, self.DIR_TRAIN))
+        self._val = self.dataset(join(self.root_dir, self.DIR_NAME, self.DIR_VAL))
         # TODO: ?
-        self._test = FastMRIDataset(join(self.root_dir, self.DIR_NAME, self.DIR_VAL), self.transform)
+        self._test = self._val if self.in_memory else self.dataset(join(self.root_dir, self.DIR_NAME, self.DIR_VAL))
+        self.resolve_loader_config()
+
+    def resolve_loader_config(self):
+        config = resolve_loader_config(type(self._train).__name__, batch_size=self.batch_size,
+                                       num_workers=self.num_workers, prefetch_factor=self.prefetch_factor,
+                                       persistent_workers=self.persistent_workers)
+        self.batch_size = config['batch_size']
+        self.num_workers = config['num_workers']
+        self.prefetch_factor = config['prefetch_factor']
+        self.persistent_workers = config['persistent_workers']
+        if self.thread_budget and self.core_budget is None:
+            # Loader threads run in the training process, their cores are taken from torch instead of workers
+            if self.loader_threads:
+                self.core_budget = CoreBudget.from_env(0, loader_threads=self.loader_threads)
+            else:
+                self.core_budget = CoreBudget.from_env(self.num_workers)
+            self.core_budget.apply_main()
+
+    def loader(self, dataset: Dataset, **kwargs) -> DataLoader:
+        if self.loader_threads and not isinstance(dataset, IterableDataset):
+            return self.wrap_loader(ThreadPoolLoader(dataset, self.batch_size, num_threads=self.loader_threads,
+                                                     collate_fn=self.collator(), **kwargs))
+        if self.core_budget is not None and self.num_workers:
+            kwargs['worker_init_fn'] = self.core_budget.worker_init_fn
+        if self.prefetch_to_device and 'sampler' not in kwargs and not isinstance(dataset, IterableDataset) \
+                and dist.is_available() and dist.is_initialized():
+            # Lightning does not add its DistributedSampler to the loader inside a BatchPrefetcher
+            kwargs['sampler'] = DistributedSampler(dataset, shuffle=kwargs.pop('shuffle', False))
+        return self.wrap_loader(DataLoader(dataset, batch_size=self.batch_size, collate_fn=self.collator(),
+                                           **loader_kwargs(self.num_workers, self.prefetch_factor,
+                                                           self.persistent_workers), **kwargs))
+
+    def collator(self):
+        """collate_fn of one loader, every loader gets its own ring of buffers."""
+        # Per-batch transforms bring their own collate, per-sample ones are stacked into ReconstructionBatch
+        collate = getattr(self.transform, 'collate', None)
+        if collate is not None:
+            return collate
+        # Worker processes always collate into new shared memory
+        if self.reuse_buffers and (self.loader_threads or not self.num_workers):
+            depth = BatchPrefetcher.DEPTH if self.prefetch_to_device else 0
+            return BatchCollator(num_buffers=BatchCollator.ring_size(depth))
+        return BatchCollator()
+
+    def on_after_batch_transfer(self, batch, dataloader_idx):
+        if isinstance(batch, LeanBatch):
+            return self.transform.expand(batch)
+        return batch
+
+    def wrap_loader(self, loader: DataLoader):
+        if not self.prefetch_to_device:
+            return loader
+        device = self.trainer.lightning_module.device if self.trainer is not None else None
+        return BatchPrefetcher(loader, device)
 
     def train_dataloader(self, *args, **kwargs) -> DataLoader:
-        return DataLoader(self._train, batch_size=self.batch_size, shuffle=True,
-                          num_workers=self.num_workers, prefetch_factor=self.prefetch_factor)
+        if isinstance(self._train, IterableDataset):
+            return self.loader(self._train)
+        if self.locality_window:
+            return self.loader(self._train, sampler=VolumeLocalitySampler(self._train, self.locality_window,
+                                                                          seed=self.random_seed))
+        return self.loader(self._train, shuffle=True)
 
     def val_dataloader(self, *args, **kwargs) -> Union[DataLoader, List[DataLoader]]:
-        return DataLoader(self._val, batch_size=self.batch_size, shuffle=False,
-                          num_workers=self.num_workers, prefetch_factor=self.prefetch_factor)
+        return self.loader(self._val, shuffle=False)
 
     def test_dataloader(self, *args, **kwargs) -> Union[DataLoader, List[DataLoader]]:
-        return DataLoader(self._test, batch_size=self.batch_size, shuffle=False,
-                          num_workers=self.num_workers, prefetch_factor=self.prefetch_factor)
+        return self.loader(self._test, shuffle=False)
 
 
 class PlFastMRIkneeH5DataModule(PlFastMRIkneeDataModule):
@@ -299,9 +929,11 @@ class PlFastMRIkneeH5DataModule(PlFastMRIkneeDataModule):
     HF_VAL = 'singlecoil_val.h5'
 
     def setup(self, stage: Optional[str] = None):
-        self._train = FastMRIh5Dataset(join(self.root_dir, self.DIR_NAME, self.HF_TRAIN), self.transform)
-        self._val = FastMRIh5Dataset(join(self.root_dir, self.DIR_NAME, self.HF_VAL), self.transform)
-        self._test = FastMRIh5Dataset(join(self.root_dir, self.DIR_NAME, self.HF_VAL), self.transform)
+        self._train = self.train_dataset(join(self.root_dir, self.DIR_NAME, self.HF_TRAIN), FastMRIh5Dataset)
+        self._val = self.dataset(join(self.root_dir, self.DIR_NAME, self.HF_VAL), FastMRIh5Dataset)
+        self._test = self._val if self.in_memory else \
+            self.dataset(join(self.root_dir, self.DIR_NAME, self.HF_VAL), FastMRIh5Dataset)
+        self.resolve_loader_config()
 
 
 if __name__ == '__main__':
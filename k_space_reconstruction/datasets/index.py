@@ -0,0 +1,172 @@
+import os
+import json
+import argparse
+import h5py
+import numpy as np
+from multiprocessing import Pool
+from os.path import isdir, join
+from typing import Callable, Dict, List, Optional, Tuple
+from k_space_reconstruction.utils.kspace import ifft2c
+
+
+INDEX_SUFFIX = '.index.json'
+
+
+def volume_maxval(ks: np.ndarray) -> float:
+    """Max of the magnitude reconstruction over all slices of a (Z, H, W) k-space volume."""
+    return float(np.abs(ifft2c(ks)).max())
+
+
+def default_index_path(path: str) -> str:
+    # Sidecar lives next to the dataset, never inside a dataset dir that is listed for volumes
+    return path.rstrip(os.sep) + INDEX_SUFFIX
+
+
+def load_index(index_path: str) -> Optional[Dict[str, dict]]:
+    if not os.path.exists(index_path):
+        return None
+    with open(index_path, 'r') as f:
+        return json.load(f)
+
+
+def save_index(index_path: str, index: Dict[str, dict], strict: bool = False) -> bool:
+    """Writes the index atomically, False when the location is not writable (OSError raised with `strict`)."""
+    tmp_path = index_path + '.tmp%d' % os.getpid()
+    try:
+        with open(tmp_path, 'w') as f:
+            json.dump(index, f, indent=1, sort_keys=True)
+        os.replace(tmp_path, index_path)
+    except OSError:
+        # Read-only dataset location, the index is kept in memory only
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        if strict:
+            raise
+        return False
+    return True
+
+
+def file_stat(fp: str) -> dict:
+    st = os.stat(fp)
+    return {'size': st.st_size, 'mtime': st.st_mtime_ns}
+
+
+def is_fresh(entry: dict, fp: str) -> bool:
+    st = file_stat(fp)
+    return entry.get('size') == st['size'] and entry.get('mtime') == st['mtime']
+
+
+def _scan_h5_key(args):
+    hf_path, key = args
+    with h5py.File(hf_path, 'r') as hf:
+        ks = hf[key][:]
+    return key, {'num_slices': int(ks.shape[0]), 'shape': list(ks.shape), 'maxval': volume_maxval(ks)}
+
+
+def _scan_h5_file(fp):
+    with h5py.File(fp, 'r') as hf:
+        ks = hf['kspace'][:]
+    return {'num_slices': int(ks.shape[0]), 'shape': list(ks.shape), 'maxval': volume_maxval(ks)}
+
+
+def parallel_map(fn: Callable, items: List, num_workers: Optional[int] = None) -> List:
+    if num_workers is None:
+        num_workers = os.cpu_count() or 1
+    num_workers = min(num_workers, len(items))
+    if num_workers <= 1:
+        return [fn(item) for item in items]
+    with Pool(num_workers) as pool:
+        return pool.map(fn, items, chunksize=1)
+
+
+def update_manifest(manifest: Dict[str, dict], files: Dict[str, str], scan_fn: Callable,
+                    num_workers: Optional[int] = None) -> Tuple[Dict[str, dict], bool]:
+    """
+    Revalidates a manifest of one entry per file, only new files and files whose size or mtime changed
+    are scanned again (in a process pool).
+
+    Args:
+        manifest: Dict name -> entry, possibly outdated.
+        files: Dict name -> file path of the current files.
+        scan_fn: Called as scan_fn(path) -> entry in the pool.
+
+    Returns:
+        tuple containing:
+            manifest with entries {'path', 'size', 'mtime', **entry} of the current files
+            whether anything changed
+    """
+    stale = [name for name, fp in files.items() if name not in manifest or not is_fresh(manifest[name], fp)]
+    changed = bool(stale) or set(manifest.keys()) != set(files.keys())
+    manifest = {name: entry for name, entry in manifest.items() if name in files and name not in stale}
+    for name, entry in zip(stale, parallel_map(scan_fn, [files[name] for name in stale], num_workers)):
+        entry.update(path=files[name], **file_stat(files[name]))
+        manifest[name] = entry
+    return manifest, changed
+
+
+def get_manifest(files: Dict[str, str], scan_fn: Callable, index_path: str,
+                 num_workers: Optional[int] = None) -> Dict[str, dict]:
+    """Loads, revalidates and saves the manifest of `files` stored at `index_path`."""
+    manifest, changed = update_manifest(load_index(index_path) or {}, files, scan_fn, num_workers)
+    if changed:
+        save_index(index_path, manifest)
+    return manifest
+
+
+def list_volumes(path: str) -> List[str]:
+    """Volume names of a fastMRI dir (file names) or of a single packed .h5 file (keys)."""
+    if isdir(path):
+        return sorted(os.listdir(path))
+    with h5py.File(path, 'r') as hf:
+        return sorted(list(hf.keys()))
+
+
+def build_index(path: str, num_workers: Optional[int] = None) -> Dict[str, dict]:
+    """
+    Computes per-volume slice count, shape and maxval of the raw (unscaled) k-space.
+
+    Args:
+        path: fastMRI dir with one volume per file or a single .h5 file with one volume per key.
+        num_workers: Size of the process pool, all cores by default.
+
+    Returns:
+        Dict volume name -> {'path', 'size', 'mtime', 'num_slices', 'shape', 'maxval'}
+    """
+    if isdir(path):
+        return update_manifest({}, {f: join(path, f) for f in list_volumes(path)}, _scan_h5_file, num_workers)[0]
+    index = dict(parallel_map(_scan_h5_key, [(path, k) for k in list_volumes(path)], num_workers))
+    for entry in index.values():
+        entry.update(path=path, **file_stat(path))
+    return index
+
+
+def get_index(path: str, index_path: Optional[str] = None, num_workers: Optional[int] = None) -> Dict[str, dict]:
+    """
+    Loads the sidecar manifest of a dataset. Entries of files whose size or mtime changed are rebuilt,
+    for a packed .h5 file that is every key of the file.
+    """
+    if index_path is None:
+        index_path = default_index_path(path)
+    if isdir(path):
+        return get_manifest({f: join(path, f) for f in list_volumes(path)}, _scan_h5_file, index_path, num_workers)
+    index = load_index(index_path)
+    if not index or not all(is_fresh(entry, path) for entry in index.values()):
+        index = build_index(path, num_workers)
+        save_index(index_path, index)
+    return index
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Precompute slice counts and maxval of fastMRI volumes')
+    parser.add_argument('path', help='fastMRI dir or packed .h5 file')
+    parser.add_argument('--index', default=None, help='sidecar path, <path>%s by default' % INDEX_SUFFIX)
+    parser.add_argument('--workers', type=int, default=None)
+    parser.add_argument('--force', action='store_true', help='rescan every volume')
+    args = parser.parse_args()
+    index_path = args.index or default_index_path(args.path)
+    if args.force and os.path.exists(index_path):
+        os.remove(index_path)
+    index = get_index(args.path, index_path, args.workers)
+    # get_index keeps the index in memory when the sidecar cannot be written, the CLI has to report it
+    save_index(index_path, index, strict=True)
+    print('%d volumes, %d slices -> %s' % (len(index), sum(v['num_slices'] for v in index.values()), index_path))
@@ -0,0 +1,277 @@
+import time
+import queue
+import threading
+import itertools
+import torch
+import torch.distributed as dist
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Iterable, Optional
+from torch.utils.data import BatchSampler, DistributedSampler, RandomSampler, Sampler, SequentialSampler
+from torch.utils.data.dataloader import default_collate
+from k_space_reconstruction.utils.threads import available_cores
+from k_space_reconstruction.datasets.batch import ReconstructionBatch, LeanBatch
+
+
+class PrefetchedBatch(tuple):
+    """Batch already staged on its device by BatchPrefetcher, unpacks like the original tuple."""
+
+
+class PrefetchedReconstructionBatch(ReconstructionBatch):
+    """ReconstructionBatch already staged on its device by BatchPrefetcher."""
+    __slots__ = ()
+
+
+class PrefetchedLeanBatch(LeanBatch):
+    """LeanBatch already staged on its device by BatchPrefetcher."""
+    __slots__ = ()
+
+
+def mark_prefetched(batch):
+    if isinstance(batch, (tuple, list)):
+        return PrefetchedBatch(batch)
+    if isinstance(batch, ReconstructionBatch):
+        return PrefetchedReconstructionBatch(*batch)
+    if isinstance(batch, LeanBatch):
+        return PrefetchedLeanBatch(*batch)
+    return batch
+
+
+def is_prefetched(batch) -> bool:
+    """True for batches BatchPrefetcher already moved, Lightning must not transfer them again."""
+    return isinstance(batch, (PrefetchedBatch, PrefetchedReconstructionBatch, PrefetchedLeanBatch))
+
+
+def stage_batch(batch, device: torch.device, pin_memory: bool):
+    """
+    Copies the tensors of a batch that need the device, strings and per-sample scalars (tensors with
+    at most one dimension, like slice_id and max_val) stay on the host.
+    """
+    if isinstance(batch, torch.Tensor):
+        if batch.dim() <= 1:
+            return batch
+        if pin_memory and not batch.is_pinned():
+            batch = batch.pin_memory()
+        return batch.to(device, non_blocking=pin_memory)
+    if isinstance(batch, (ReconstructionBatch, LeanBatch)):
+        return type(batch)(*(stage_batch(x, device, pin_memory) for x in batch))
+    if isinstance(batch, (tuple, list)):
+        if all(isinstance(x, str) for x in batch):
+            return batch
+        return type(batch)(stage_batch(x, device, pin_memory) for x in batch)
+    if isinstance(batch, dict):
+        return {k: stage_batch(v, device, pin_memory) for k, v in batch.items()}
+    return batch
+
+
+class BatchPrefetcher(object):
+    """
+    Wraps a DataLoader and stages the next `depth` batches on `device` from a background thread
+    while the current step runs. On CUDA the host to device copies are pinned, asynchronous and
+    issued on a side stream. On CPU it only overlaps fetching (and the collate of a loader
+    without workers) with the step.
+
+    Lightning only adds its DistributedSampler to plain DataLoaders, under DDP build the wrapped loader
+    with one. Its epoch is set on every iteration like Lightning does.
+
+        loader = BatchPrefetcher(DataLoader(dataset, batch_size=8, num_workers=12), device='cuda')
+        for ks, mask, y, x, mean, std, f_name, slice_id, max_val in loader:
+            ...
+        print(loader.stats())
+
+    Attributes:
+        fetch_time: Seconds the background thread spent fetching and staging batches.
+        wait_time: Seconds the consumer spent blocked waiting for a batch.
+        num_batches: Number of batches delivered.
+    """
+
+    DEPTH = 2
+
+    def __init__(self, loader: Iterable, device: Optional[torch.device] = None, depth: int = DEPTH,
+                 pin_memory: Optional[bool] = None):
+        self.loader = loader
+        self.device = torch.device(device) if device is not None else torch.device('cpu')
+        self.depth = depth
+        self.pin_memory = self.device.type == 'cuda' if pin_memory is None else pin_memory
+        self.fetch_time = 0.0
+        self.wait_time = 0.0
+        self.num_batches = 0
+        self.epoch = 0
+
+    def __len__(self):
+        return len(self.loader)
+
+    def set_epoch(self, epoch: int):
+        """Epoch of the next iteration."""
+        self.epoch = epoch
+
+    @property
+    def dataset(self):
+        return self.loader.dataset
+
+    def _produce(self, batches: queue.Queue, stop: threading.Event):
+        stream = torch.cuda.Stream(self.device) if self.device.type == 'cuda' else None
+        try:
+            it = iter(self.loader)
+            while not stop.is_set():
+                t = time.perf_counter()
+                try:
+                    batch = next(it)
+                except StopIteration:
+                    break
+                event = None
+                if stream is not None:
+                    with torch.cuda.stream(stream):
+                        batch = stage_batch(batch, self.device, self.pin_memory)
+                        event = torch.cuda.Event()
+                        event.record(stream)
+                elif self.device.type != 'cpu':
+                    batch = stage_batch(batch, self.device, self.pin_memory)
+                self.fetch_time += time.perf_counter() - t
+                self._put(batches, stop, (batch, event, None))
+        except Exception as e:
+            self._put(batches, stop, (None, None, e))
+            return
+        self._put(batches, stop, (None, None, None))
+
+    @staticmethod
+    def _put(batches: queue.Queue, stop: threading.Event, item):
+        # Gives up once the consumer has stopped iterating, it will never empty the queue
+        while not stop.is_set():
+            try:
+                batches.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                pass
+
+    def __iter__(self):
+        sampler = getattr(self.loader, 'sampler', None)
+        if isinstance(sampler, DistributedSampler):
+            sampler.set_epoch(self.epoch)
+        self.epoch += 1
+        batches = queue.Queue(maxsize=self.depth)
+        stop = threading.Event()
+        thread = threading.Thread(target=self._produce, args=(batches, stop), daemon=True)
+        thread.start()
+        try:
+            while True:
+                t = time.perf_counter()
+                batch, event, error = batches.get()
+                self.wait_time += time.perf_counter() - t
+                if error is not None:
+                    raise error
+                if batch is None:
+                    break
+                if event is not None:
+                    torch.cuda.current_stream(self.device).wait_event(event)
+                    self._record_stream(batch)
+                self.num_batches += 1
+                yield mark_prefetched(batch)
+        finally:
+            stop.set()
+            thread.join()
+
+    def _record_stream(self, batch):
+        # Memory of tensors copied on the side stream must not be reused before the step is done with it
+        if isinstance(batch, torch.Tensor):
+            if batch.is_cuda:
+                batch.record_stream(torch.cuda.current_stream(self.device))
+        elif isinstance(batch, (tuple, list, ReconstructionBatch, LeanBatch)):
+            for x in batch:
+                self._record_stream(x)
+        elif isinstance(batch, dict):
+            for x in batch.values():
+                self._record_stream(x)
+
+    def stats(self) -> dict:
+        """
+        Seconds spent fetching in the background vs waiting. `overlapped` is the fetch time of this run
+        the consumer did not wait for, an upper bound of what prefetching hid behind the steps; the actual
+        saving needs a comparison with a run without the prefetcher.
+        """
+        return {
+            'batches': self.num_batches,
+            'fetch_time': self.fetch_time,
+            'wait_time': self.wait_time,
+            'overlapped': max(self.fetch_time - self.wait_time, 0.0),
+        }
+
+
+class ThreadPoolLoader(object):
+    """
+    DataLoader replacement fetching samples on a pool of threads of the training process. The slice reads
+    and transforms of the next `prefetch_batches` batches run concurrently, the FFTs and array math of
+    the transforms release the GIL, and batches are collated in the consumer thread without pickling
+    or shared memory.
+
+    Reads of h5py datasets (FastMRIh5Dataset, FastMRIDataset) are serialized by h5py, the transforms
+    still overlap. With torch.distributed initialized and no sampler given, every rank reads its own part
+    through a DistributedSampler. The epoch of a sampler with `set_epoch` advances with every iteration,
+    Lightning only injects and advances samplers of DataLoaders. Datasets with `thread_safe = False` are fetched one sample at a time in the pool,
+    which still overlaps loading with the training step.
+
+        loader = ThreadPoolLoader(FastMRIDataset(dir_path, transform), batch_size=8, shuffle=True,
+                                  num_threads=8, collate_fn=BatchCollator())
+
+    Args:
+        num_threads: Pool size, the cores of the process by default.
+        prefetch_batches: Batches in flight ahead of the one being consumed.
+    """
+
+    def __init__(self, dataset, batch_size: int = 1, shuffle: bool = False, sampler: Optional[Sampler] = None,
+                 num_threads: Optional[int] = None, collate_fn: Optional[Callable] = None, drop_last: bool = False,
+                 prefetch_batches: int = 2):
+        if sampler is not None and shuffle:
+            raise ValueError('sampler and shuffle are mutually exclusive')
+        self.dataset = dataset
+        self.batch_size = batch_size
+        if sampler is None:
+            if dist.is_available() and dist.is_initialized():
+                sampler = DistributedSampler(dataset, shuffle=shuffle)
+            else:
+                sampler = RandomSampler(dataset) if shuffle else SequentialSampler(dataset)
+        self.sampler = sampler
+        self.epoch = 0
+        self.batch_sampler = BatchSampler(sampler, batch_size, drop_last)
+        self.num_threads = num_threads or len(available_cores())
+        self.collate_fn = collate_fn or default_collate
+        self.prefetch_batches = max(prefetch_batches, 1)
+        self.thread_safe = getattr(dataset, 'thread_safe', True)
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.batch_sampler)
+
+    def set_epoch(self, epoch: int):
+        """Epoch of the next iteration."""
+        self.epoch = epoch
+
+    def fetch(self, index):
+        if self.thread_safe:
+            return self.dataset[index]
+        with self._lock:
+            return self.dataset[index]
+
+    def __iter__(self):
+        if hasattr(self.sampler, 'set_epoch'):
+            self.sampler.set_epoch(self.epoch)
+        self.epoch += 1
+        batches = iter(self.batch_sampler)
+        pending = deque()
+        with ThreadPoolExecutor(self.num_threads, thread_name_prefix='loader') as pool:
+
+            def submit(n):
+                for indices in itertools.islice(batches, n):
+                    pending.append([pool.submit(self.fetch, i) for i in indices])
+
+            try:
+                submit(self.prefetch_batches)
+                while pending:
+                    futures = pending.popleft()
+                    submit(1)
+                    yield self.collate_fn([f.result() for f in futures])
+            finally:
+                # Stopped early: drop what has not started, the pool waits for the rest
+                for futures in pending:
+                    for f in futures:
+                        f.cancel()
@@ -0,0 +1,193 @@
+import os
+import json
+import shutil
+import argparse
+import numpy as np
+import torch
+from os.path import join, exists
+from typing import Optional, Sequence
+from torch.utils.data.dataset import T_co
+from torch.utils.data import Dataset
+from k_space_reconstruction.utils.codecs import CODECS, get_codec, measure_codec_error
+from k_space_reconstruction.datasets.index import get_index
+from k_space_reconstruction.datasets.prepared import iter_prepared_volumes, prepared_fingerprint
+
+
+KSPACE_FILE = 'kspace.npy'
+TARGET_FILE = 'target.npy'
+KSPACE_SCALE_FILE = 'kspace_scale.npy'
+TARGET_SCALE_FILE = 'target_scale.npy'
+INDEX_FILE = 'index.json'
+# Volumes whose middle slice goes into the codec error measurement
+CODEC_ERROR_VOLUMES = 32
+
+
+def is_memmap_store(path: str) -> bool:
+    return exists(join(path, INDEX_FILE)) and exists(join(path, KSPACE_FILE))
+
+
+def default_store_path(source: str) -> str:
+    return source.rstrip(os.sep) + '.mmap'
+
+
+def load_store_index(path: str) -> dict:
+    with open(join(path, INDEX_FILE), 'r') as f:
+        return json.load(f)
+
+
+def write_memmap_store(source: str, out_dir: str, target_shape: Sequence[int] = (320, 320), scale: float = 1e6,
+                       num_workers: Optional[int] = None, codec: str = 'complex64') -> str:
+    """
+    Writes center cropped slices of a fastMRI dir or packed .h5 file back-to-back into flat .npy files.
+
+    Layout of `out_dir`:
+        kspace.npy: (N, H, W) cropped k-space, complex64 or encoded by `codec`
+        target.npy: (N, H, W) target magnitude images, float32 or encoded by `codec`
+        kspace_scale.npy, target_scale.npy: float32 (N,) per-slice codec scales, for scaled codecs only
+        index.json: per slice f_name, slice_id, maxval, per volume offset table and the codec
+            error measured on the middle slices of the first volumes
+    """
+    index = get_index(source, num_workers=num_workers)
+    num_slices = sum(v['num_slices'] for v in index.values())
+    shape = tuple(target_shape)
+    slice_codec = get_codec(codec)
+    tmp_dir = out_dir.rstrip(os.sep) + '.tmp'
+    if exists(tmp_dir):
+        shutil.rmtree(tmp_dir)
+    os.makedirs(tmp_dir)
+    ks_shape, ks_dtype = slice_codec.storage((num_slices,) + shape, True)
+    t_shape, t_dtype = slice_codec.storage((num_slices,) + shape, False)
+    kspace = np.lib.format.open_memmap(join(tmp_dir, KSPACE_FILE), mode='w+', dtype=ks_dtype, shape=ks_shape)
+    target = np.lib.format.open_memmap(join(tmp_dir, TARGET_FILE), mode='w+', dtype=t_dtype, shape=t_shape)
+    kspace_scales, target_scales = [], []
+    error_kspace, error_target = [], []
+    volumes, f_names, slice_ids, maxvals = [], [], [], []
+    i = 0
+    for f_name, k, t, maxval in iter_prepared_volumes(source, shape, scale, num_workers):
+        z = k.shape[0]
+        kspace[i:i + z], k_scale = slice_codec.encode(k)
+        target[i:i + z], t_scale = slice_codec.encode(t)
+        if k_scale is not None:
+            kspace_scales.append(k_scale)
+            target_scales.append(t_scale)
+        if len(error_kspace) < CODEC_ERROR_VOLUMES:
+            error_kspace.append(k[z // 2])
+            error_target.append(t[z // 2])
+        volumes.append({'f_name': f_name, 'offset': i, 'num_slices': z})
+        f_names += [f_name] * z
+        slice_ids += list(range(z))
+        maxvals += [maxval] * z
+        i += z
+    kspace.flush()
+    target.flush()
+    del kspace, target
+    if kspace_scales:
+        np.save(join(tmp_dir, KSPACE_SCALE_FILE), np.concatenate(kspace_scales))
+        np.save(join(tmp_dir, TARGET_SCALE_FILE), np.concatenate(target_scales))
+    with open(join(tmp_dir, INDEX_FILE), 'w') as f:
+        json.dump({
+            'fingerprint': prepared_fingerprint(source, shape, scale, codec),
+            'target_shape': list(shape),
+            'scale': scale,
+            'codec': codec,
+            'codec_error': measure_codec_error(slice_codec, np.stack(error_kspace), np.stack(error_target)),
+            'volumes': volumes,
+            'f_name': f_names,
+            'slice_id': slice_ids,
+            'maxval': maxvals,
+        }, f)
+    if exists(out_dir):
+        shutil.rmtree(out_dir)
+    os.replace(tmp_dir, out_dir)
+    return out_dir
+
+
+class FastMRIMemmapDataset(Dataset):
+    """
+    Drop-in replacement of FastMRIh5Dataset serving cropped slices straight from the page cache.
+
+    `path` is either a store written by `write_memmap_store` or a fastMRI dir / packed .h5 file,
+    in which case the store is built next to it (or at `store_path`) and rebuilt when stale.
+
+    Only the cropped slices are stored, so without a transform a sample is the (2, H, W) cropped k-space
+    of one slice, where FastMRIh5Dataset returns the whole uncropped volume.
+    """
+
+    def __init__(self, path, transform, store_path=None, scale=1e6, num_workers=None, codec='complex64'):
+        super(FastMRIMemmapDataset, self).__init__()
+        self.transform = transform
+        if not is_memmap_store(path):
+            target_shape = transform.target_shape if transform else (320, 320)
+            store_path = store_path or default_store_path(path)
+            fingerprint = prepared_fingerprint(path, target_shape, scale, codec)
+            if not is_memmap_store(store_path) or load_store_index(store_path)['fingerprint'] != fingerprint:
+                write_memmap_store(path, store_path, target_shape, scale, num_workers, codec)
+            path = store_path
+        self.path = path
+        index = load_store_index(path)
+        self.codec = get_codec(index.get('codec', 'complex64'))
+        self.codec_error = index.get('codec_error')
+        self.volumes = index['volumes']
+        self._maxvals = index['maxval']
+        self._slices = list(zip(index['f_name'], index['slice_id']))
+        if hasattr(transform, 'add_source'):
+            # Cached validation samples are tied to the store they were computed from
+            transform.add_source(sorted(set(index['f_name'])), index['fingerprint'])
+        self._kspace = None
+        self._target = None
+        self._kspace_scale = None
+        self._target_scale = None
+
+    def _open(self):
+        # Copy-on-write private mappings: writable for torch.from_numpy, pages stay shared with the page cache
+        self._kspace = np.load(join(self.path, KSPACE_FILE), mmap_mode='c')
+        self._target = np.load(join(self.path, TARGET_FILE), mmap_mode='c')
+        if exists(join(self.path, KSPACE_SCALE_FILE)):
+            self._kspace_scale = np.load(join(self.path, KSPACE_SCALE_FILE))
+            self._target_scale = np.load(join(self.path, TARGET_SCALE_FILE))
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        for k in ('_kspace', '_target', '_kspace_scale', '_target_scale'):
+            state[k] = None
+        return state
+
+    def __len__(self):
+        return len(self._slices)
+
+    def read_slice(self, index):
+        """Decoded complex64 k-space and float32 target of a slice."""
+        if self._kspace is None:
+            self._open()
+        if self._kspace_scale is None:
+            return self._kspace[index], self._target[index]
+        return (self.codec.decode(self._kspace[index], self._kspace_scale[index], True),
+                self.codec.decode(self._target[index], self._target_scale[index], False))
+
+    def __getitem__(self, index) -> T_co:
+        f_name, slice_id = self._slices[index]
+        if hasattr(self.transform, 'cached'):
+            sample = self.transform.cached(f_name, slice_id)
+            if sample is not None:
+                return sample
+        ks, target = self.read_slice(index)
+        if self.transform:
+            return self.transform.sample(f_name, slice_id, ks, target, self._maxvals[index])
+        else:
+            return torch.view_as_real(torch.from_numpy(ks)).permute(2, 0, 1)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Write a memory-mapped store of center cropped fastMRI slices')
+    parser.add_argument('source', help='fastMRI dir or packed .h5 file')
+    parser.add_argument('--out', default=None, help='store dir, <source>.mmap by default')
+    parser.add_argument('--shape', type=int, nargs=2, default=[320, 320])
+    parser.add_argument('--scale', type=float, default=1e6)
+    parser.add_argument('--workers', type=int, default=None)
+    parser.add_argument('--codec', default='complex64', choices=sorted(CODECS.keys()))
+    args = parser.parse_args()
+    out = write_memmap_store(args.source, args.out or default_store_path(args.source), args.shape, args.scale,
+                             args.workers, args.codec)
+    index = load_store_index(out)
+    print('%d slices -> %s' % (len(index['f_name']), out))
+    print('%s codec error: %s' % (args.codec, index['codec_error']))
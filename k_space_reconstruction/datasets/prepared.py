@@ -0,0 +1,185 @@
+import os
+import json
+import hashlib
+import argparse
+import h5py
+import numpy as np
+import torch
+from multiprocessing import Pool
+from os.path import isdir, join
+from typing import Iterator, Optional, Sequence, Tuple
+from torch.utils.data.dataset import T_co
+from torch.utils.data import Dataset
+from k_space_reconstruction.utils.kspace import center_crop_kspace
+from k_space_reconstruction.utils.io import H5FilePool
+from k_space_reconstruction.datasets.index import get_index, list_volumes
+
+
+PREPARED_VERSION = 1
+
+
+def source_stats(source: str):
+    """(name, size, mtime) of every file backing a fastMRI dir or packed .h5 file."""
+    if isdir(source):
+        files = [join(source, f) for f in sorted(os.listdir(source))]
+    else:
+        files = [source]
+    return [(os.path.basename(f), os.stat(f).st_size, os.stat(f).st_mtime_ns) for f in files]
+
+
+def prepared_fingerprint(source: str, target_shape: Sequence[int], scale: float, codec: str = 'complex64') -> str:
+    params = {
+        'version': PREPARED_VERSION,
+        'target_shape': list(target_shape),
+        'scale': scale,
+        'source': source_stats(source),
+    }
+    if codec != 'complex64':
+        params['codec'] = codec
+    return hashlib.md5(json.dumps(params, sort_keys=True).encode()).hexdigest()
+
+
+def volume_f_name(source: str, name: str) -> str:
+    # Same f_name the FastMRIDataset / FastMRIh5Dataset pass to the transform
+    return join(source, name) if isdir(source) else name
+
+
+def read_volume(source: str, name: str) -> np.ndarray:
+    if isdir(source):
+        with h5py.File(join(source, name), 'r') as hf:
+            return hf['kspace'][:]
+    with h5py.File(source, 'r') as hf:
+        return hf[name][:]
+
+
+def _crop_volume(args):
+    source, name, target_shape, scale = args
+    ks = read_volume(source, name) * scale
+    cropped = [center_crop_kspace(k, target_shape) for k in ks]
+    k_space = np.stack([k for k, _ in cropped]).astype(np.complex64)
+    target = np.stack([r for _, r in cropped]).astype(np.float32)
+    return name, k_space, target
+
+
+def iter_prepared_volumes(source: str, target_shape: Sequence[int] = (320, 320), scale: float = 1e6,
+                          num_workers: Optional[int] = None) -> Iterator[Tuple[str, np.ndarray, np.ndarray, float]]:
+    """
+    Yields center cropped volumes of a fastMRI dir or packed .h5 file in dataset order.
+
+    Args:
+        source: fastMRI dir or packed .h5 file.
+        target_shape: Shape of the cropped slices.
+        scale: K-space scale factor, FastMRIh5Dataset.SCALE by default.
+        num_workers: Size of the process pool, all cores by default.
+
+    Returns:
+        Iterator of (f_name, complex64 (Z, H, W) k-space, float32 (Z, H, W) target, maxval)
+    """
+    index = get_index(source, num_workers=num_workers)
+    items = [(source, name, tuple(target_shape), scale) for name in list_volumes(source)]
+    if num_workers is None:
+        num_workers = os.cpu_count() or 1
+    if num_workers <= 1:
+        for name, k_space, target in map(_crop_volume, items):
+            yield volume_f_name(source, name), k_space, target, index[name]['maxval'] * scale
+    else:
+        with Pool(num_workers) as pool:
+            for name, k_space, target in pool.imap(_crop_volume, items):
+                yield volume_f_name(source, name), k_space, target, index[name]['maxval'] * scale
+
+
+def prepare(source: str, out_path: str, target_shape: Sequence[int] = (320, 320), scale: float = 1e6,
+            num_workers: Optional[int] = None) -> str:
+    """
+    Writes cropped complex64 k-space, target magnitude images, maxval and slice index into a new .h5 file.
+    """
+    index = get_index(source, num_workers=num_workers)
+    num_slices = sum(v['num_slices'] for v in index.values())
+    shape = tuple(target_shape)
+    tmp_path = out_path + '.tmp'
+    f_names, slice_ids, maxvals = [], [], []
+    with h5py.File(tmp_path, 'w') as hf:
+        ks_ds = hf.create_dataset('kspace', shape=(num_slices,) + shape, dtype=np.complex64, chunks=(1,) + shape)
+        target_ds = hf.create_dataset('target', shape=(num_slices,) + shape, dtype=np.float32, chunks=(1,) + shape)
+        i = 0
+        for f_name, k_space, target, maxval in iter_prepared_volumes(source, shape, scale, num_workers):
+            z = k_space.shape[0]
+            ks_ds[i:i + z] = k_space
+            target_ds[i:i + z] = target
+            f_names += [f_name] * z
+            slice_ids += list(range(z))
+            maxvals += [maxval] * z
+            i += z
+        hf.create_dataset('f_name', data=np.array(f_names, dtype=object), dtype=h5py.string_dtype())
+        hf.create_dataset('slice_id', data=np.array(slice_ids, dtype=np.int32))
+        hf.create_dataset('maxval', data=np.array(maxvals, dtype=np.float64))
+        hf.attrs['fingerprint'] = prepared_fingerprint(source, shape, scale)
+        hf.attrs['target_shape'] = shape
+        hf.attrs['scale'] = scale
+    os.replace(tmp_path, out_path)
+    return out_path
+
+
+def is_prepared(path: str, source: str, target_shape: Sequence[int], scale: float) -> bool:
+    if not os.path.exists(path):
+        return False
+    with h5py.File(path, 'r') as hf:
+        return hf.attrs.get('fingerprint') == prepared_fingerprint(source, target_shape, scale)
+
+
+class FastMRIPreparedDataset(Dataset):
+    """
+    Reads a store written by `prepare`, only the random part of the transform (noise, mask,
+    normalization) runs at load time. If `source` is given, a missing or stale store is rebuilt.
+    """
+
+    def __init__(self, path, transform, source=None, target_shape=None, scale=1e6, num_workers=None):
+        super(FastMRIPreparedDataset, self).__init__()
+        if target_shape is None:
+            target_shape = transform.target_shape if transform else (320, 320)
+        if source is not None and not is_prepared(path, source, target_shape, scale):
+            prepare(source, path, target_shape, scale, num_workers)
+        self.path = path
+        self.files = H5FilePool(max_open=1)
+        self.transform = transform
+        with h5py.File(path, 'r') as hf:
+            self._maxvals = hf['maxval'][:]
+            self._slices = list(zip(hf['f_name'].asstr()[:], hf['slice_id'][:].tolist()))
+            fingerprint = hf.attrs['fingerprint']
+        if hasattr(transform, 'add_source'):
+            # Cached validation samples are tied to the store they were computed from
+            transform.add_source(sorted(set(f_name for f_name, _ in self._slices)), fingerprint)
+
+    @property
+    def hf(self) -> h5py.File:
+        return self.files.get(self.path)
+
+    def __len__(self):
+        return len(self._slices)
+
+    def __getitem__(self, index) -> T_co:
+        f_name, slice_id = self._slices[index]
+        if hasattr(self.transform, 'cached'):
+            sample = self.transform.cached(f_name, slice_id)
+            if sample is not None:
+                return sample
+        ks = self.hf['kspace'][index]
+        if self.transform:
+            target = self.hf['target'][index]
+            return self.transform.sample(f_name, slice_id, ks, target, float(self._maxvals[index]))
+        else:
+            return torch.as_tensor(np.stack((ks.real, ks.imag)), dtype=torch.float)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Write a center cropped fastMRI training store')
+    parser.add_argument('source', help='fastMRI dir or packed .h5 file')
+    parser.add_argument('out', help='output .h5 file')
+    parser.add_argument('--shape', type=int, nargs=2, default=[320, 320])
+    parser.add_argument('--scale', type=float, default=1e6)
+    parser.add_argument('--workers', type=int, default=None)
+    parser.add_argument('--force', action='store_true', help='rebuild even if the store is up to date')
+    args = parser.parse_args()
+    if args.force or not is_prepared(args.out, args.source, args.shape, args.scale):
+        prepare(args.source, args.out, args.shape, args.scale, args.workers)
+    print('%s is up to date' % args.out)
@@ -0,0 +1,92 @@
+import math
+import numpy as np
+import torch.distributed as dist
+from typing import Hashable, Iterator, List, Optional, Sequence
+from torch.utils.data import Dataset, DistributedSampler
+from k_space_reconstruction.utils.cache import LRUCache
+
+
+def volume_groups(dataset: Dataset) -> List[List[int]]:
+    """Dataset indices grouped by volume, from the (volume, slice_id) pairs of `dataset._slices`."""
+    groups = {}
+    for i, (volume, _) in enumerate(dataset._slices):
+        groups.setdefault(volume, []).append(i)
+    return list(groups.values())
+
+
+def estimate_volume_reuse(indices: Sequence[int], volume_of: Sequence[Hashable], cache_volumes: int) -> float:
+    """
+    Fraction of reads in `indices` whose volume is among the `cache_volumes` most recently read volumes.
+
+    A model of the sampling order only: an LRU over volume ids read in order by a single process. It
+    says nothing about real cache hits, which depend on the H5FilePool size, the HDF5 chunk and OS page
+    caches and how workers interleave the batches.
+    """
+    cache = LRUCache(max_items=cache_volumes)
+    for i in indices:
+        if cache.get(volume_of[i]) is None:
+            cache.put(volume_of[i], True)
+    return cache.hit_rate
+
+
+class VolumeLocalitySampler(DistributedSampler):
+    """
+    Shuffles the order of volumes, then the slices inside consecutive windows of `window` volumes.
+
+    Every slice is still drawn once per epoch and any slice can follow any other one, but a batch
+    only touches a few volumes so the HDF5 chunk cache and the OS readahead keep working.
+    In distributed mode every rank gets a contiguous part of the epoch, which keeps the locality
+    per rank. Being a DistributedSampler, Lightning uses it as is instead of replacing it.
+
+    Args:
+        dataset: Dataset with `_slices` of (volume, slice_id) like FastMRIh5Dataset.
+        window: Number of volumes whose slices are shuffled together.
+        volumes: Dataset indices grouped by volume, taken from `dataset._slices` if None.
+        cache_volumes: Volumes assumed to stay cached in `volume_reuse`, `window` by default.
+        num_replicas, rank: Taken from torch.distributed if initialized, else 1 and 0.
+
+    Attributes:
+        volume_reuse: `estimate_volume_reuse` of the last epoch on this rank, not a measured hit rate.
+    """
+
+    def __init__(self, dataset: Dataset, window: int = 4, volumes: Optional[List[List[int]]] = None,
+                 cache_volumes: Optional[int] = None, num_replicas: Optional[int] = None,
+                 rank: Optional[int] = None, shuffle: bool = True, seed: int = 0, drop_last: bool = False):
+        if window < 1:
+            raise ValueError('window should be a positive integer, got %d' % window)
+        distributed = dist.is_available() and dist.is_initialized()
+        if num_replicas is None:
+            num_replicas = dist.get_world_size() if distributed else 1
+        if rank is None:
+            rank = dist.get_rank() if distributed else 0
+        super(VolumeLocalitySampler, self).__init__(dataset, num_replicas, rank, shuffle, seed, drop_last)
+        self.window = window
+        self.volumes = volumes if volumes is not None else volume_groups(dataset)
+        self.cache_volumes = cache_volumes or window
+        self._volume_of = np.empty(len(dataset), dtype=np.int64)
+        for v, indices in enumerate(self.volumes):
+            self._volume_of[indices] = v
+        self.volume_reuse = None
+
+    def epoch_indices(self) -> List[int]:
+        """Windowed order of the whole epoch, the same on every rank."""
+        if not self.shuffle:
+            return [i for indices in self.volumes for i in indices]
+        rng = np.random.default_rng((self.seed, self.epoch))
+        order = rng.permutation(len(self.volumes))
+        indices = []
+        for w in range(0, len(order), self.window):
+            window = np.concatenate([self.volumes[v] for v in order[w:w + self.window]])
+            indices += rng.permutation(window).tolist()
+        return indices
+
+    def __iter__(self) -> Iterator[int]:
+        indices = self.epoch_indices()
+        if not self.drop_last:
+            padding = self.total_size - len(indices)
+            indices += (indices * math.ceil(padding / len(indices)))[:padding]
+        else:
+            indices = indices[:self.total_size]
+        indices = indices[self.rank * self.num_samples:(self.rank + 1) * self.num_samples]
+        self.volume_reuse = estimate_volume_reuse(indices, self._volume_of, self.cache_volumes)
+        return iter(indices)
@@ -0,0 +1,261 @@
+import os
+import json
+import shutil
+import hashlib
+import argparse
+import numpy as np
+import torch
+from os.path import join, exists
+from typing import Dict, Iterator, List, Optional, Sequence, Tuple
+from torch.utils.data.dataset import T_co
+from torch.utils.data import Dataset
+from k_space_reconstruction.utils.io import get_file_md5hash
+from k_space_reconstruction.datasets.prepared import iter_prepared_volumes, prepared_fingerprint
+from k_space_reconstruction.datasets.stream import EpochIterableDataset
+
+
+META_FILE = 'shards.json'
+OFFSETS_FILE = 'offsets.bin'
+SHARD_FILE = 'shard-%05d.bin'
+# One record per slice: shard number, byte offset in the shard, slice_id, maxval and volume number
+OFFSET_DTYPE = np.dtype([('shard', '<u4'), ('offset', '<u8'), ('slice_id', '<u4'), ('maxval', '<f8'),
+                         ('volume', '<u4')])
+
+
+def is_shard_store(path: str) -> bool:
+    return exists(join(path, META_FILE)) and exists(join(path, OFFSETS_FILE))
+
+
+def load_shard_meta(path: str) -> dict:
+    with open(join(path, META_FILE), 'r') as f:
+        return json.load(f)
+
+
+def load_offsets(path: str) -> np.ndarray:
+    return np.fromfile(join(path, OFFSETS_FILE), dtype=OFFSET_DTYPE)
+
+
+def record_layout(target_shape: Sequence[int]) -> Tuple[int, int]:
+    """Bytes of the complex64 k-space and of the float32 target of one slice record."""
+    size = int(np.prod(target_shape))
+    return size * np.dtype(np.complex64).itemsize, size * np.dtype(np.float32).itemsize
+
+
+def decode_record(buf, target_shape: Sequence[int]) -> Tuple[np.ndarray, np.ndarray]:
+    ks_bytes, target_bytes = record_layout(target_shape)
+    ks = np.frombuffer(buf, dtype=np.complex64, count=ks_bytes // 8).reshape(target_shape)
+    target = np.frombuffer(buf, dtype=np.float32, count=target_bytes // 4, offset=ks_bytes).reshape(target_shape)
+    return ks, target
+
+
+def pack_shards(source: str, out_dir: str, target_shape: Sequence[int] = (320, 320), scale: float = 1e6,
+                shard_bytes: int = 256 * 2 ** 20, num_workers: Optional[int] = None) -> str:
+    """
+    Packs center cropped slices of a fastMRI dir or packed .h5 file into fixed-size shard files.
+
+    Layout of `out_dir`:
+        shard-%05d.bin: slice records back-to-back, complex64 (H, W) k-space followed by float32 (H, W) target
+        offsets.bin: OFFSET_DTYPE record per slice in dataset order
+        shards.json: target_shape, scale, fingerprint, volume names and per shard size, slice count and md5
+
+    Args:
+        shard_bytes: Shards are closed once the next record would exceed this size (at least one record).
+    """
+    shape = tuple(target_shape)
+    record_bytes = sum(record_layout(shape))
+    records_per_shard = max(shard_bytes // record_bytes, 1)
+    tmp_dir = out_dir.rstrip(os.sep) + '.tmp'
+    if exists(tmp_dir):
+        shutil.rmtree(tmp_dir)
+    os.makedirs(tmp_dir)
+    offsets, shards, volumes = [], [], []
+    f, hs, count = None, None, 0
+
+    def close_shard():
+        f.close()
+        shards.append({'file': SHARD_FILE % len(shards), 'size': count * record_bytes, 'num_slices': count,
+                       'md5': hs.hexdigest()})
+
+    for f_name, k_space, target, maxval in iter_prepared_volumes(source, shape, scale, num_workers):
+        for slice_id in range(k_space.shape[0]):
+            if f is None or count == records_per_shard:
+                if f is not None:
+                    close_shard()
+                f, hs, count = open(join(tmp_dir, SHARD_FILE % len(shards)), 'wb'), hashlib.md5(), 0
+            record = k_space[slice_id].tobytes() + target[slice_id].tobytes()
+            f.write(record)
+            hs.update(record)
+            offsets.append((len(shards), count * record_bytes, slice_id, maxval, len(volumes)))
+            count += 1
+        volumes.append(f_name)
+    if f is not None:
+        close_shard()
+    np.array(offsets, dtype=OFFSET_DTYPE).tofile(join(tmp_dir, OFFSETS_FILE))
+    with open(join(tmp_dir, META_FILE), 'w') as meta:
+        json.dump({
+            'fingerprint': prepared_fingerprint(source, shape, scale),
+            'target_shape': list(shape),
+            'scale': scale,
+            'record_bytes': record_bytes,
+            'volumes': volumes,
+            'shards': shards,
+        }, meta, indent=1)
+    if exists(out_dir):
+        shutil.rmtree(out_dir)
+    os.replace(tmp_dir, out_dir)
+    return out_dir
+
+
+def verify_shards(path: str) -> List[str]:
+    """Shard files whose size or md5 differ from shards.json, every shard is checked on its own."""
+    bad = []
+    for shard in load_shard_meta(path)['shards']:
+        fp = join(path, shard['file'])
+        if not exists(fp) or os.path.getsize(fp) != shard['size'] or get_file_md5hash(fp) != shard['md5']:
+            bad.append(shard['file'])
+    return bad
+
+
+def iter_shard(path: str, shard_id: int, meta: Optional[dict] = None) -> Iterator[Tuple[int, np.ndarray, np.ndarray]]:
+    """Reads a shard in one sequential read, yields (record number in the shard, k-space, target)."""
+    meta = meta or load_shard_meta(path)
+    shape = tuple(meta['target_shape'])
+    with open(join(path, meta['shards'][shard_id]['file']), 'rb') as f:
+        buf = f.read()
+    for i in range(len(buf) // meta['record_bytes']):
+        yield (i,) + decode_record(memoryview(buf)[i * meta['record_bytes']:(i + 1) * meta['record_bytes']], shape)
+
+
+class ShardStore(object):
+    """Single-slice reads of a shard store, one pread per slice on per-process file descriptors."""
+
+    def __init__(self, path: str):
+        self.path = path
+        self.meta = load_shard_meta(path)
+        self.offsets = load_offsets(path)
+        self.target_shape = tuple(self.meta['target_shape'])
+        self.f_names = self.meta['volumes']
+        self._fds: Dict[int, int] = {}
+        self._pid = os.getpid()
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_fds'] = {}
+        return state
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def fd(self, shard_id: int) -> int:
+        if self._pid != os.getpid():
+            # Forked worker, descriptors share their offset with the parent but pread does not use it
+            self._fds, self._pid = {}, os.getpid()
+        if shard_id not in self._fds:
+            self._fds[shard_id] = os.open(join(self.path, self.meta['shards'][shard_id]['file']), os.O_RDONLY)
+        return self._fds[shard_id]
+
+    def read(self, index: int) -> Tuple[np.ndarray, np.ndarray]:
+        rec = self.offsets[index]
+        buf = os.pread(self.fd(int(rec['shard'])), self.meta['record_bytes'], int(rec['offset']))
+        return decode_record(buf, self.target_shape)
+
+    def close(self):
+        for fd in self._fds.values():
+            os.close(fd)
+        self._fds = {}
+
+
+class FastMRIShardDataset(Dataset):
+    """Map-style dataset over a store written by `pack_shards`, built from `source` if missing or stale."""
+
+    def __init__(self, path, transform, source=None, scale=1e6, shard_bytes=256 * 2 ** 20, num_workers=None):
+        super(FastMRIShardDataset, self).__init__()
+        if source is not None:
+            target_shape = transform.target_shape if transform else (320, 320)
+            if not is_shard_store(path) or \
+                    load_shard_meta(path)['fingerprint'] != prepared_fingerprint(source, target_shape, scale):
+                pack_shards(source, path, target_shape, scale, shard_bytes, num_workers)
+        self.store = ShardStore(path)
+        self.transform = transform
+        if hasattr(transform, 'add_source'):
+            # Cached validation samples are tied to the store they were computed from
+            transform.add_source(self.store.f_names, self.store.meta['fingerprint'])
+
+    def __len__(self):
+        return len(self.store)
+
+    def __getitem__(self, index) -> T_co:
+        rec = self.store.offsets[index]
+        f_name, slice_id = self.store.f_names[rec['volume']], int(rec['slice_id'])
+        if hasattr(self.transform, 'cached'):
+            sample = self.transform.cached(f_name, slice_id)
+            if sample is not None:
+                return sample
+        ks, target = self.store.read(index)
+        if self.transform:
+            return self.transform.sample(f_name, slice_id, ks, target, float(rec['maxval']))
+        else:
+            return torch.view_as_real(torch.from_numpy(ks.copy())).permute(2, 0, 1)
+
+
+class FastMRIShardStream(EpochIterableDataset):
+    """
+    Reads whole shards sequentially, shards are split between ranks and DataLoader workers.
+    With `shuffle` the shard order and the slice order inside each shard change every epoch,
+    see EpochIterableDataset for how epochs are counted and shards are split between ranks.
+    Every rank needs at least one shard, pack smaller shards for more ranks.
+    """
+
+    def __init__(self, path, transform, shuffle=True, seed=0):
+        super(FastMRIShardStream, self).__init__()
+        self.path = path
+        self.transform = transform
+        self.shuffle = shuffle
+        self.seed = seed
+        self.meta = load_shard_meta(path)
+        offsets = load_offsets(path)
+        self._first = np.searchsorted(offsets['shard'], np.arange(len(self.meta['shards'])))
+        self._offsets = offsets
+        self._sizes = np.bincount(offsets['shard'], minlength=len(self.meta['shards'])).tolist()
+
+    def part_sizes(self) -> List[int]:
+        return self._sizes
+
+    def __iter__(self):
+        rank, _ = self.replica()
+        worker_id, _ = self.worker()
+        epoch = self.next_epoch()
+        shards, limit = self.worker_parts(epoch)
+        rng = np.random.default_rng((self.seed, epoch, rank, worker_id))
+        for shard_id in shards:
+            if limit <= 0:
+                return
+            records = list(iter_shard(self.path, shard_id, self.meta))
+            if self.shuffle:
+                records = [records[i] for i in rng.permutation(len(records))]
+            for i, ks, target in records[:limit]:
+                if not self.transform:
+                    yield torch.view_as_real(torch.from_numpy(ks.copy())).permute(2, 0, 1)
+                    continue
+                rec = self._offsets[self._first[shard_id] + i]
+                yield self.transform.sample(self.meta['volumes'][rec['volume']], int(rec['slice_id']), ks, target,
+                                            float(rec['maxval']))
+            limit -= len(records)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Pack center cropped fastMRI slices into fixed-size shards')
+    parser.add_argument('source', nargs='?', default=None, help='fastMRI dir or packed .h5 file, not needed with --verify')
+    parser.add_argument('out', help='output dir')
+    parser.add_argument('--shape', type=int, nargs=2, default=[320, 320])
+    parser.add_argument('--scale', type=float, default=1e6)
+    parser.add_argument('--shard-mb', type=int, default=256)
+    parser.add_argument('--workers', type=int, default=None)
+    parser.add_argument('--verify', action='store_true', help='only check the md5 of every shard')
+    args = parser.parse_args()
+    if not args.verify and args.source is None:
+        parser.error('source is required unless --verify is given')
+    if not args.verify:
+        pack_shards(args.source, args.out, args.shape, args.scale, args.shard_mb * 2 ** 20, args.workers)
+    bad = verify_shards(args.out)
+    print('%d shards, %d bad %s' % (len(load_shard_meta(args.out)['shards']), len(bad), ' '.join(bad)))
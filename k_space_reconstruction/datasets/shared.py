@@ -0,0 +1,150 @@
+import os
+import weakref
+import numpy as np
+import torch
+from multiprocessing import shared_memory
+from typing import Optional, Sequence
+from torch.utils.data.dataset import T_co
+from torch.utils.data import Dataset
+from k_space_reconstruction.utils.codecs import get_codec
+from k_space_reconstruction.datasets.index import get_index
+from k_space_reconstruction.datasets.prepared import iter_prepared_volumes, prepared_fingerprint
+
+
+def _release(segments, owner):
+    for shm in segments:
+        try:
+            shm.close()
+        except BufferError:
+            # Slices still referenced somewhere, the mapping goes away with them
+            pass
+        if os.getpid() != owner:
+            # Forked DataLoader workers inherit the finalizer, only the owner unlinks
+            continue
+        try:
+            shm.unlink()
+        except FileNotFoundError:
+            pass
+
+
+class SharedSliceStore(object):
+    """
+    Center cropped k-space (complex64) and target images (float32) of a whole fastMRI dir or packed
+    .h5 file in POSIX shared memory, optionally stored with a reduced-precision `codec` and decoded
+    per slice on access.
+
+    The process creating the store owns the segments and unlinks them when the store is garbage
+    collected or `close` is called. Pickled copies (e.g. in DataLoader workers) attach to the same
+    segments by name as read-only arrays, nothing is copied.
+    """
+
+    def __init__(self, source: str, target_shape: Sequence[int] = (320, 320), scale: float = 1e6,
+                 num_workers: Optional[int] = None, codec: str = 'complex64'):
+        index = get_index(source, num_workers=num_workers)
+        num_slices = sum(v['num_slices'] for v in index.values())
+        self.shape = (num_slices,) + tuple(target_shape)
+        self.codec = get_codec(codec)
+        self.fingerprint = prepared_fingerprint(source, target_shape, scale, codec)
+        self._storage = (self.codec.storage(self.shape, True), self.codec.storage(self.shape, False))
+        kspace_shm, target_shm = [shared_memory.SharedMemory(create=True, size=int(np.prod(shape)) * dtype.itemsize)
+                                  for shape, dtype in self._storage]
+        self._finalizer = weakref.finalize(self, _release, [kspace_shm, target_shm], os.getpid())
+        self._segments = (kspace_shm, target_shm)
+        self.names = (kspace_shm.name, target_shm.name)
+        kspace, target = self._views()
+        kspace_scales, target_scales = [], []
+        self.f_names, self.slice_ids, self.maxvals = [], [], []
+        i = 0
+        for f_name, k, t, maxval in iter_prepared_volumes(source, target_shape, scale, num_workers):
+            z = k.shape[0]
+            kspace[i:i + z], k_scale = self.codec.encode(k)
+            target[i:i + z], t_scale = self.codec.encode(t)
+            kspace_scales.append(k_scale)
+            target_scales.append(t_scale)
+            self.f_names += [f_name] * z
+            self.slice_ids += list(range(z))
+            self.maxvals += [maxval] * z
+            i += z
+        del kspace, target
+        self.kspace_scale = np.concatenate(kspace_scales) if kspace_scales[0] is not None else None
+        self.target_scale = np.concatenate(target_scales) if target_scales[0] is not None else None
+        self._arrays = None
+
+    def _views(self):
+        return tuple(np.ndarray(shape, dtype=dtype, buffer=shm.buf)
+                     for (shape, dtype), shm in zip(self._storage, self._segments))
+
+    @property
+    def nbytes(self) -> int:
+        return sum(shm.size for shm in self._segments)
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        for k in ('_finalizer', '_segments', '_arrays'):
+            state[k] = None
+        return state
+
+    def _attach(self):
+        if self._segments is None:
+            # Workers share the resource tracker of the owner, attaching does not add a second registration
+            self._segments = tuple(shared_memory.SharedMemory(name=name) for name in self.names)
+        kspace, target = self._views()
+        kspace.flags.writeable = False
+        target.flags.writeable = False
+        self._arrays = (kspace, target)
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __getitem__(self, index):
+        if self._arrays is None:
+            self._attach()
+        if self.kspace_scale is None:
+            return self._arrays[0][index], self._arrays[1][index]
+        return (self.codec.decode(self._arrays[0][index], self.kspace_scale[index], True),
+                self.codec.decode(self._arrays[1][index], self.target_scale[index], False))
+
+    def close(self):
+        self._arrays = None
+        if self._finalizer is not None:
+            self._finalizer()
+        elif self._segments is not None:
+            for shm in self._segments:
+                shm.close()
+        self._segments = None
+
+
+class FastMRISharedDataset(Dataset):
+    """
+    Serves the slices of a fastMRI dir or packed .h5 file from a SharedSliceStore, loaded once by the
+    process building the dataset. Epochs never touch the disk and workers share a single copy.
+    """
+
+    def __init__(self, source, transform, scale=1e6, num_workers=None, store=None, codec='complex64'):
+        super(FastMRISharedDataset, self).__init__()
+        self.source = source
+        self.transform = transform
+        if store is None:
+            target_shape = transform.target_shape if transform else (320, 320)
+            store = SharedSliceStore(source, target_shape, scale, num_workers, codec)
+        self.store = store
+        # (volume, slice_id) pairs like FastMRIh5Dataset, VolumeLocalitySampler groups slices by them
+        self._slices = list(zip(store.f_names, store.slice_ids))
+        if hasattr(transform, 'add_source'):
+            # Cached validation samples are tied to the store they were computed from
+            transform.add_source(sorted(set(store.f_names)), store.fingerprint)
+
+    def __len__(self):
+        return len(self.store)
+
+    def __getitem__(self, index) -> T_co:
+        f_name, slice_id = self._slices[index]
+        if hasattr(self.transform, 'cached'):
+            sample = self.transform.cached(f_name, slice_id)
+            if sample is not None:
+                return sample
+        ks, target = self.store[index]
+        if self.transform:
+            return self.transform.sample(f_name, slice_id, ks, target, self.store.maxvals[index])
+        else:
+            return torch.view_as_real(torch.from_numpy(ks.copy())).permute(2, 0, 1)
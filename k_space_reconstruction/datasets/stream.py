@@ -0,0 +1,172 @@
+import numpy as np
+import torch
+import torch.distributed as dist
+from typing import Iterator, List, Tuple
+from torch.utils.data import IterableDataset, get_worker_info
+from k_space_reconstruction.datasets.index import get_index, list_volumes
+from k_space_reconstruction.datasets.prepared import read_volume, volume_f_name
+
+
+class EpochIterableDataset(IterableDataset):
+    """
+    Epoch bookkeeping of iterable datasets split between ranks and DataLoader workers. Lightning does not
+    call `set_epoch` on iterable datasets, so every iteration of a worker counts as an epoch, `set_epoch`
+    restarts the count from an explicit epoch.
+
+    Subclasses read whole parts (volumes, shards) of `part_sizes` slices. Every epoch deals the parts,
+    shuffled with `seed` if `shuffle`, to the rank with the fewest slices so far, and every rank then
+    yields exactly `len` slices, so DDP ranks never run out at different steps. Per-rank totals differ
+    by at most one part, the cap drops at most (world_size - 1) / world_size of the largest part per rank.
+    """
+    MAX_WORKERS = 256
+
+    def __init__(self):
+        super(EpochIterableDataset, self).__init__()
+        self.epoch = 0
+        # Iterations done per worker slot, shared with the workers so every worker agrees on the epoch
+        self._iterations = torch.zeros(self.MAX_WORKERS, dtype=torch.int64).share_memory_()
+
+    def set_epoch(self, epoch: int):
+        self.epoch = epoch
+        self._iterations.zero_()
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        # Spawned DataLoader workers have no process group, they keep the replica of the training process
+        state['_replica'] = self.replica()
+        return state
+
+    def replica(self) -> Tuple[int, int]:
+        if getattr(self, '_replica', None) is not None:
+            return self._replica
+        if dist.is_available() and dist.is_initialized():
+            return dist.get_rank(), dist.get_world_size()
+        return 0, 1
+
+    @staticmethod
+    def worker() -> Tuple[int, int]:
+        info = get_worker_info()
+        return (info.id, info.num_workers) if info is not None else (0, 1)
+
+    def next_epoch(self) -> int:
+        """Epoch of the iteration the calling worker starts."""
+        slot, _ = self.worker()
+        epoch = self.epoch + int(self._iterations[slot])
+        self._iterations[slot] += 1
+        return epoch
+
+    def part_sizes(self) -> List[int]:
+        raise NotImplementedError
+
+    def __len__(self):
+        _, world_size = self.replica()
+        sizes = self.part_sizes()
+        if world_size == 1:
+            return sum(sizes)
+        if len(sizes) < world_size:
+            raise ValueError('%d parts (volumes or shards) for %d ranks, every rank needs at least one'
+                             % (len(sizes), world_size))
+        # Lower bound of the smallest rank total after `rank_parts`, the same in every epoch
+        return max(sum(sizes) - (world_size - 1) * max(sizes), 0) // world_size
+
+    def rank_parts(self, epoch: int) -> List[List[int]]:
+        """Parts of every rank in `epoch`, each part goes to the rank with the fewest slices so far."""
+        _, world_size = self.replica()
+        sizes = self.part_sizes()
+        order = np.arange(len(sizes))
+        if self.shuffle:
+            order = np.random.default_rng((self.seed, epoch)).permutation(order)
+        ranks, loads = [[] for _ in range(world_size)], np.zeros(world_size, dtype=np.int64)
+        for part in order:
+            r = int(np.argmin(loads))
+            ranks[r].append(int(part))
+            loads[r] += sizes[part]
+        return ranks
+
+    def worker_parts(self, epoch: int) -> Tuple[List[int], int]:
+        """Parts read by the calling worker in `epoch` and how many of their slices it yields."""
+        rank, _ = self.replica()
+        worker_id, num_workers = self.worker()
+        sizes = self.part_sizes()
+        parts = self.rank_parts(epoch)[rank]
+        shards = [parts[w::num_workers] for w in range(num_workers)]
+        counts = np.array([sum(sizes[p] for p in shard) for shard in shards])
+        # The slices of the rank are split between its workers in proportion to what they read
+        total = len(self)
+        limits = total * counts // max(counts.sum(), 1)
+        for w in np.flatnonzero(limits < counts)[:total - limits.sum()]:
+            limits[w] += 1
+        return shards[worker_id], int(limits[worker_id])
+
+
+class FastMRIStreamDataset(EpochIterableDataset):
+    """
+    Streams whole fastMRI volumes sequentially, every DataLoader worker (and every rank) reads its own
+    disjoint shard of volumes. Cropped slices go through a shuffle buffer of `buffer_size` slices per
+    worker, the random part of the transform (`transform.sample`) runs when a slice leaves the buffer.
+
+    The volume order and the buffer are reseeded every epoch, see EpochIterableDataset for how epochs
+    are counted and volumes are split between ranks. Without distributed training `len` is the number
+    of slices.
+
+    Args:
+        path: fastMRI dir or packed .h5 file.
+        transform: FastMRITransform or any transform with `crop` and `sample`, None yields the uncropped
+            k-space slices as (2, H, W) tensors.
+        buffer_size: Slices held by the shuffle buffer of each worker, 1 disables shuffling within volumes.
+        seed: Base seed of the volume order and of the shuffle buffer.
+    """
+    SCALE = 1e6
+
+    def __init__(self, path, transform, buffer_size=64, seed=0, shuffle=True, index_path=None, num_workers=None):
+        super(FastMRIStreamDataset, self).__init__()
+        self.path = path
+        self.transform = transform
+        self.buffer_size = max(buffer_size, 1)
+        self.seed = seed
+        self.shuffle = shuffle
+        self.index = get_index(path, index_path, num_workers)
+        self.volumes = list_volumes(path)
+
+    def part_sizes(self) -> List[int]:
+        return [self.index[v]['num_slices'] for v in self.volumes]
+
+    def shard(self, epoch: int) -> Tuple[List[str], int]:
+        """Volumes read by the calling worker in `epoch` and how many of their slices it yields."""
+        parts, limit = self.worker_parts(epoch)
+        return [self.volumes[i] for i in parts], limit
+
+    def read_slices(self, volumes: List[str], limit: int) -> Iterator[tuple]:
+        for name in volumes:
+            if limit <= 0:
+                return
+            ks = read_volume(self.path, name) * self.SCALE
+            maxval = self.index[name]['maxval'] * self.SCALE
+            f_name = volume_f_name(self.path, name)
+            for slice_id in range(ks.shape[0]):
+                if limit <= 0:
+                    return
+                limit -= 1
+                k_space, recon = self.transform.crop(ks[slice_id]) if self.transform else (ks[slice_id], None)
+                yield f_name, slice_id, k_space, recon, maxval
+
+    def sample(self, f_name, slice_id, k_space, recon, maxval):
+        if self.transform:
+            return self.transform.sample(f_name, slice_id, k_space, recon, maxval)
+        return torch.view_as_real(torch.from_numpy(k_space.copy())).permute(2, 0, 1)
+
+    def __iter__(self):
+        epoch = self.next_epoch()
+        slot, _ = self.worker()
+        rank, _ = self.replica()
+        rng = np.random.default_rng((self.seed, epoch, rank, slot))
+        buffer = []
+        for item in self.read_slices(*self.shard(epoch)):
+            if len(buffer) < self.buffer_size:
+                buffer.append(item)
+                continue
+            i = rng.integers(len(buffer))
+            buffer[i], item = item, buffer[i]
+            yield self.sample(*item)
+        for i in rng.permutation(len(buffer)):
+            yield self.sample(*buffer[i])
@@ -3,6 +3,7 @@ import torch.nn.functional as F
 from k_space_reconstruction.nets.base import BaseReconstructionModule
 from k_space_reconstruction.nets.unet import Unet
 from k_space_reconstruction.utils.kspace import pt_spatial2kspace, pt_kspace2spatial
+from k_space_reconstruction.datasets.batch import ReconstructionBatch
 
 
 class ActiveLayer(torch.nn.Module):
@@ -34,8 +35,8 @@ class UnetAFModule(BaseReconstructionModule):
         return self.net[1](x).squeeze(1)
 
     def predict(self, batch):
-        ks, mask, y, x, mean, std, f_name, slice_id, max_val = batch
-        x = self.net[0](x, mean, std)
+        batch = ReconstructionBatch.of(batch)
+        x = self.net[0](batch.sampled_image, batch.mean, batch.std)
         return self.net[1](x)
 
     def get_net(self, **kwargs):
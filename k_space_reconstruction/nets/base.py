@@ -19,6 +19,8 @@ from torch.optim import Optimizer
 
 from k_space_reconstruction.utils.loss import RAdam
 from k_space_reconstruction.utils.metrics import nmse, psnr, ssim, vif, pt_msssim, pt_ssim
+from k_space_reconstruction.datasets.loader import is_prefetched
+from k_space_reconstruction.datasets.batch import ReconstructionBatch
 
 
 class DistributedMetricSum(pl.metrics.Metric):
@@ -61,31 +63,37 @@ class BaseReconstructionModule(pl.LightningModule):
     def get_net(self, **kwargs):
         raise NotImplemented
 
+    def transfer_batch_to_device(self, batch, *args, **kwargs):
+        # The hook is (batch, device) before PL 1.4 and (batch, device, dataloader_idx) after
+        if is_prefetched(batch):
+            # Staged by BatchPrefetcher, per-sample scalars are meant to stay on the host
+            return batch
+        return super().transfer_batch_to_device(batch, *args, **kwargs)
+
     def predict(self, batch):
-        ks, mask, y, x, mean, std, f_name, slice_id, max_val = batch
-        return self.net(x)
+        return self.net(ReconstructionBatch.of(batch).sampled_image)
 
     def training_step(self, batch, batch_idx):
-        ks, mask, y, x, mean, std, f_name, slice_id, max_val = batch
+        batch = ReconstructionBatch.of(batch)
         yp = self.predict(batch)
-        loss = self.criterion(yp, y, mean, std)
+        loss = self.criterion(yp, batch.target, batch.mean, batch.std)
         if torch.isnan(loss):
             print('warn')
         self.log('train_loss_step', loss.detach(), sync_dist=True)
         return loss
 
     def validation_step(self, batch, batch_idx):
-        ks, mask, y, x, mean, std, f_name, slice_id, max_val = batch
+        batch = ReconstructionBatch.of(batch)
         yp = self.predict(batch)
-        loss = self.criterion(yp, y, mean, std)
+        loss = self.criterion(yp, batch.target, batch.mean, batch.std)
         return {
             'batch_idx': batch_idx,
-            'f_name': f_name,
-            'slice_id': slice_id,
-            'max_val': max_val,
-            'input': x * std + mean,
-            'output': yp * std + mean,
-            'target': y * std + mean,
+            'f_name': batch.f_name,
+            'slice_id': batch.slice_id,
+            'max_val': batch.max_val,
+            'input': batch.sampled_image * batch.std + batch.mean,
+            'output': yp * batch.std + batch.mean,
+            'target': batch.target * batch.std + batch.mean,
             'val_loss': loss
         }
 
@@ -177,12 +185,12 @@ class BaseReconstructionModule(pl.LightningModule):
             self.log(metric, value / tot_examples, sync_dist=True)
 
     def test_step(self, batch, batch_idx):
-        ks, mask, y, x, mean, std, f_name, slice_id, max_val = batch
+        batch = ReconstructionBatch.of(batch)
         yp = self.predict(batch)
         return {
-            'f_name': f_name,
-            'slice_id': slice_id,
-            'output': (yp * std + mean).cpu().numpy()
+            'f_name': batch.f_name,
+            'slice_id': batch.slice_id,
+            'output': (yp * batch.std + batch.mean).cpu().numpy()
         }
 
     def test_epoch_end(self, test_logs) -> None:
@@ -6,6 +6,7 @@ from k_space_reconstruction.utils.kspace import pt_kspace2spatial as FtH
 from k_space_reconstruction.utils.kspace import pt_spatial2kspace as Ft
 from k_space_reconstruction.nets.unet import Unet
 from k_space_reconstruction.nets.dncnn import DnCNN
+from k_space_reconstruction.datasets.batch import ReconstructionBatch
 
 
 PADDING_MODE = 'zeros'
@@ -27,8 +28,8 @@ class CDDNwTDCModule(BaseReconstructionModule):
         )
 
     def predict(self, batch):
-        ks, mask, y, x, mean, std, f_name, slice_id, max_val = batch
-        return self.net(ks, mask, x, mean, std)
+        batch = ReconstructionBatch.of(batch)
+        return self.net(batch.k_space, batch.mask, batch.sampled_image, batch.mean, batch.std)
 
 
 class CDDNwTDC(nn.Module):
@@ -17,6 +17,7 @@ from k_space_reconstruction.nets.mwcnn import MWCNN
 from k_space_reconstruction.nets.unet import Unet
 from k_space_reconstruction.nets.cddn import DataConsistencyModule, DataConsistencyLLearnableModule
 from k_space_reconstruction.nets.cddn import DLAFModule, DCSuperAFModule, DCSuperAFModuleV2, DCSuperAFModuleV3, DCSuperAFModuleV4
+from k_space_reconstruction.datasets.batch import ReconstructionBatch
 
 
 class ComplexModule(BaseReconstructionModule):
@@ -30,31 +31,31 @@ class ComplexModule(BaseReconstructionModule):
         return (x*std + mean).abs().squeeze(1)
 
     def predict(self, batch):
-        ks, mask, y, x, mean, std, f_name, slice_id, max_val = batch
-        x = self.net(ks, mask, x, mean, std)
-        return (x*std + mean).abs()
+        batch = ReconstructionBatch.of(batch)
+        x = self.net(batch.k_space, batch.mask, batch.sampled_image, batch.mean, batch.std)
+        return (x*batch.std + batch.mean).abs()
 
     def validation_step(self, batch, batch_idx):
-        ks, mask, y, x, mean, std, f_name, slice_id, max_val = batch
+        batch = ReconstructionBatch.of(batch)
         yp = self.predict(batch)
-        loss = self.criterion(yp, y)
+        loss = self.criterion(yp, batch.target)
         return {
             'batch_idx': batch_idx,
-            'f_name': f_name,
-            'slice_id': slice_id,
-            'max_val': max_val,
-            'input': (x * std + mean).abs(),
+            'f_name': batch.f_name,
+            'slice_id': batch.slice_id,
+            'max_val': batch.max_val,
+            'input': (batch.sampled_image * batch.std + batch.mean).abs(),
             'output': yp,
-            'target': y,
+            'target': batch.target,
             'val_loss': loss
         }
 
     def test_step(self, batch, batch_idx):
-        ks, mask, y, x, mean, std, f_name, slice_id, max_val = batch
+        batch = ReconstructionBatch.of(batch)
         yp = self.predict(batch)
         return {
-            'f_name': f_name,
-            'slice_id': slice_id,
+            'f_name': batch.f_name,
+            'slice_id': batch.slice_id,
             'output': yp.cpu().numpy()
         }
 
@@ -72,10 +73,11 @@ class C_CascadeModule(ComplexModule):
         return (x*std + mean).abs().squeeze(1)
 
     def predict(self, batch):
-        ks, mask, y, x, mean, std, f_name, slice_id, max_val = batch
+        batch = ReconstructionBatch.of(batch)
+        x = batch.sampled_image
         for cascade in self.net:
-            x = cascade(ks, mask, x, mean, std)
-        return (x*std + mean).abs()
+            x = cascade(batch.k_space, batch.mask, x, batch.mean, batch.std)
+        return (x*batch.std + batch.mean).abs()
 
     def get_net(self, **kwargs):
         return None
@@ -93,9 +95,10 @@ class CascadeModule(BaseReconstructionModule):
         return x
 
     def predict(self, batch):
-        ks, mask, y, x, mean, std, f_name, slice_id, max_val = batch
+        batch = ReconstructionBatch.of(batch)
+        x = batch.sampled_image
         for cascade in self.net:
-            x = cascade(ks, mask, x, mean, std)
+            x = cascade(batch.k_space, batch.mask, x, batch.mean, batch.std)
         return x
 
     def get_net(self, **kwargs):
@@ -18,6 +18,7 @@ from k_space_reconstruction.utils.kspace import pt_spatial2kspace as Ft
 from k_space_reconstruction.nets.base import BaseReconstructionModule
 
 from k_space_reconstruction.nets.cddn import DataConsistencyModule, DataConsistencyLLearnableModule, DCSuperAFModuleV2
+from k_space_reconstruction.datasets.batch import ReconstructionBatch
 
 
 class CascadeModule(BaseReconstructionModule):
@@ -35,9 +36,10 @@ class CascadeModule(BaseReconstructionModule):
         return x
 
     def predict(self, batch):
-        ks, mask, y, x, mean, std, f_name, slice_id, max_val = batch
+        batch = ReconstructionBatch.of(batch)
+        x = batch.sampled_image
         for cascade in self.net:
-            x = cascade(ks, mask, x, mean, std)
+            x = cascade(batch.k_space, batch.mask, x, batch.mean, batch.std)
         return x
 
     def get_net(self, **kwargs):
@@ -0,0 +1,76 @@
+from collections import OrderedDict
+from typing import Any, Callable, Hashable, Optional
+
+
+class LRUCache(object):
+    """
+    Least recently used cache with a bounded number of items and/or bytes and hit/miss counters.
+
+    Args:
+        max_items: Maximum number of cached items, unbounded if None.
+        on_evict: Called as on_evict(key, value) for every item dropped from the cache.
+        max_bytes: Maximum total size of the cached values, unbounded if None.
+        sizeof: Size of a value in bytes, required with max_bytes.
+    """
+
+    def __init__(self, max_items: Optional[int] = None, on_evict: Optional[Callable[[Hashable, Any], None]] = None,
+                 max_bytes: Optional[int] = None, sizeof: Optional[Callable[[Any], int]] = None):
+        if max_bytes is not None and sizeof is None:
+            raise ValueError('sizeof is required with max_bytes')
+        self.max_items = max_items
+        self.on_evict = on_evict
+        self.max_bytes = max_bytes
+        self.sizeof = sizeof
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._items = OrderedDict()
+
+    def __len__(self):
+        return len(self._items)
+
+    def __contains__(self, key):
+        return key in self._items
+
+    def get(self, key, default=None):
+        if key in self._items:
+            self._items.move_to_end(key)
+            self.hits += 1
+            return self._items[key]
+        self.misses += 1
+        return default
+
+    def put(self, key, value):
+        if key in self._items:
+            self._discard(key, self._items.pop(key))
+        if self.max_bytes is not None and self.sizeof(value) > self.max_bytes:
+            # Never cache a value larger than the whole cache
+            if self.on_evict is not None:
+                self.on_evict(key, value)
+            return
+        self._items[key] = value
+        if self.sizeof is not None:
+            self.nbytes += self.sizeof(value)
+        while self.max_items is not None and len(self._items) > self.max_items:
+            self._evict()
+        while self.max_bytes is not None and self.nbytes > self.max_bytes:
+            self._evict()
+
+    def _discard(self, key, value):
+        if self.sizeof is not None:
+            self.nbytes -= self.sizeof(value)
+        if self.on_evict is not None:
+            self.on_evict(key, value)
+
+    def _evict(self):
+        key, value = self._items.popitem(last=False)
+        self._discard(key, value)
+
+    def clear(self):
+        while self._items:
+            self._evict()
+
+    @property
+    def hit_rate(self) -> float:
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
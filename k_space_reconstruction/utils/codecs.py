@@ -0,0 +1,122 @@
+import numpy as np
+from typing import Dict, Optional, Tuple
+from k_space_reconstruction.utils.kspace import ifft2c
+from k_space_reconstruction.utils.metrics import nmse, ssim
+
+
+class SliceCodec(object):
+    """
+    Storage format of a stack of (N, H, W) complex k-space or real image slices.
+
+    `encode` returns the stored array and a per-slice float32 scale (None if unused), `decode` turns
+    stored slices back into complex64 or float32, it is cheap enough to run in the loader.
+    """
+    name = None
+
+    def storage(self, shape, is_complex: bool) -> Tuple[tuple, np.dtype]:
+        raise NotImplementedError
+
+    def encode(self, x: np.ndarray) -> Tuple[np.ndarray, Optional[np.ndarray]]:
+        raise NotImplementedError
+
+    def decode(self, data: np.ndarray, scale: Optional[np.ndarray], is_complex: bool) -> np.ndarray:
+        raise NotImplementedError
+
+
+class RawCodec(SliceCodec):
+    """complex64 / float32 as is."""
+    name = 'complex64'
+
+    def storage(self, shape, is_complex):
+        return tuple(shape), np.dtype(np.complex64 if is_complex else np.float32)
+
+    def encode(self, x):
+        return x.astype(np.complex64 if np.iscomplexobj(x) else np.float32, copy=False), None
+
+    def decode(self, data, scale, is_complex):
+        return data
+
+
+class ScaledCodec(SliceCodec):
+    """
+    Real and imaginary parts as pairs of a smaller dtype, each slice divided by `max |x| / PEAK`.
+    The per-slice scale keeps scaled k-space away from float16 overflow and uses the whole int16 range.
+    """
+    dtype = None
+    PEAK = None
+
+    def storage(self, shape, is_complex):
+        return tuple(shape) + ((2,) if is_complex else ()), np.dtype(self.dtype)
+
+    def slice_scale(self, x: np.ndarray) -> np.ndarray:
+        peak = np.abs(x).reshape(x.shape[0], -1).max(axis=1)
+        return (np.where(peak > 0, peak, 1.0) / self.PEAK).astype(np.float32)
+
+    def quantize(self, x: np.ndarray) -> np.ndarray:
+        return x.astype(self.dtype)
+
+    def encode(self, x):
+        scale = self.slice_scale(x)
+        x = x / scale.reshape((-1,) + (1,) * (x.ndim - 1))
+        if np.iscomplexobj(x):
+            x = np.stack((x.real, x.imag), axis=-1)
+        return self.quantize(x), scale
+
+    def decode(self, data, scale, is_complex):
+        scale = np.asarray(scale, dtype=np.float32)
+        x = data.astype(np.float32) * scale.reshape(scale.shape + (1,) * (data.ndim - scale.ndim))
+        if is_complex:
+            return x.view(np.complex64)[..., 0]
+        return x
+
+
+class Float16Codec(ScaledCodec):
+    """float16 pairs (complex32), half of complex64."""
+    name = 'float16'
+    dtype = np.float16
+    # Far below the float16 max of 65504, slices of a volume differ a lot less than that
+    PEAK = 2.0 ** 14
+
+
+class Int16Codec(ScaledCodec):
+    """Per-slice scaled int16 pairs, half of complex64 with a uniform quantization step."""
+    name = 'int16'
+    dtype = np.int16
+    PEAK = 32767.0
+
+    def quantize(self, x):
+        return np.rint(x).astype(self.dtype)
+
+
+CODECS = {codec.name: codec for codec in (RawCodec, Float16Codec, Int16Codec)}
+
+
+def get_codec(name: str) -> SliceCodec:
+    if name not in CODECS:
+        raise ValueError('Unknown codec %s, expected one of %s' % (name, sorted(CODECS.keys())))
+    return CODECS[name]()
+
+
+def measure_codec_error(codec: SliceCodec, kspace: np.ndarray, target: np.ndarray) -> Dict[str, float]:
+    """
+    Error of a codec round trip against the complex64 / float32 pipeline.
+
+    Args:
+        codec: SliceCodec.
+        kspace: complex64 (N, H, W) cropped k-space.
+        target: float32 (N, H, W) target magnitude images.
+
+    Returns:
+        Dict with NMSE and SSIM of the fully sampled magnitude reconstruction from the decoded k-space
+        ('kspace_nmse', 'kspace_ssim') and of the decoded target ('target_nmse', 'target_ssim')
+    """
+    kspace_rt = codec.decode(*codec.encode(kspace), is_complex=True)
+    target_rt = codec.decode(*codec.encode(target), is_complex=False)
+    recon = np.abs(ifft2c(kspace))
+    recon_rt = np.abs(ifft2c(kspace_rt))
+    return {
+        'kspace_nmse': float(nmse(recon, recon_rt)),
+        'kspace_ssim': float(ssim(recon, recon_rt)),
+        'target_nmse': float(nmse(target, target_rt)),
+        'target_ssim': float(ssim(target, target_rt)),
+    }
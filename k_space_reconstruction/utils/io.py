@@ -1,6 +1,14 @@
 import os
+import json
+import queue
 import hashlib
+import itertools
+import threading
+import h5py
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from tqdm import tqdm
+from k_space_reconstruction.utils.cache import LRUCache
 
 
 def update_hash_on_file(fp, hs):
@@ -16,11 +24,201 @@ def get_file_md5hash(fp):
     return hs.hexdigest()
 
 
-def get_dir_md5hash(dp):
-    hs = hashlib.md5()
+def get_file_stat_hash(fp):
+    """md5 of the size and mtime of a file, changes when it is rewritten without reading it."""
+    st = os.stat(fp)
+    return hashlib.md5(('%d %d' % (st.st_size, st.st_mtime_ns)).encode()).hexdigest()
+
+
+def list_dir_files(dp):
     files = []
     for root, _, fs in os.walk(dp):
         files += [os.path.join(root, f) for f in fs]
-    for f in tqdm(sorted(files)):
+    return sorted(files)
+
+
+def get_dir_md5hash(dp):
+    hs = hashlib.md5()
+    for f in tqdm(list_dir_files(dp)):
         update_hash_on_file(f, hs)
     return hs.hexdigest()
+
+
+class _ReadCancelled(Exception):
+    pass
+
+
+def _put_chunk(chunks: queue.Queue, item, cancel: threading.Event):
+    # Gives up once the consumer stopped, nothing will drain the queue any more
+    while not cancel.is_set():
+        try:
+            chunks.put(item, timeout=0.1)
+            return
+        except queue.Full:
+            pass
+    raise _ReadCancelled()
+
+
+def _read_file_chunks(fp, buffer_size, chunks: queue.Queue, cancel: threading.Event):
+    try:
+        with open(fp, 'rb', buffering=0) as f:
+            for chunk in iter(lambda: f.read(buffer_size), b''):
+                _put_chunk(chunks, chunk, cancel)
+    finally:
+        try:
+            _put_chunk(chunks, None, cancel)
+        except _ReadCancelled:
+            pass
+
+
+def _iter_chunks(chunks: queue.Queue, future):
+    # A reader that died before queueing its end marker is noticed through its future
+    while True:
+        try:
+            chunk = chunks.get(timeout=0.1)
+        except queue.Empty:
+            if future.done() and chunks.empty():
+                future.result()
+                return
+            continue
+        if chunk is None:
+            return
+        yield chunk
+
+
+def get_dir_md5hash_cached(dp, cache_path=None, num_workers=4, buffer_size=8 * 2 ** 20, max_chunks=4):
+    """
+    Same digest as get_dir_md5hash, computed with parallel read-ahead and a digest cache.
+
+    The digest is the md5 of all files concatenated in sorted order (the value the data modules pin as
+    DIR_HASH), so it can not be assembled from per-file digests and any change means reading every file.
+    If no file changed its (path, size, mtime) since the last run the cached digest is returned without
+    reading anything. Otherwise `num_workers` threads read the files ahead in `buffer_size` chunks and
+    queue them for the digest, which is updated in order. `changed_files` of the cache tells what changed.
+
+    Args:
+        dp: Dataset dir.
+        cache_path: JSON digest cache, next to the dir by default. Must not be inside `dp`.
+        num_workers: Number of reader threads.
+        buffer_size: Read size in bytes.
+        max_chunks: Chunks queued per file, bounds memory to num_workers * max_chunks * buffer_size.
+
+    Returns:
+        hex digest
+    """
+    if cache_path is None:
+        cache_path = dp.rstrip(os.sep) + '.md5.json'
+    cache = {}
+    if os.path.exists(cache_path):
+        with open(cache_path, 'r') as f:
+            cache = json.load(f)
+    cached_files = cache.get('files', {})
+
+    files = list_dir_files(dp)
+    stats = {}
+    for fp in files:
+        st = os.stat(fp)
+        stats[os.path.relpath(fp, dp)] = {'size': st.st_size, 'mtime': st.st_mtime_ns}
+    tree_key = hashlib.md5(json.dumps(stats, sort_keys=True).encode()).hexdigest()
+    if cache.get('tree') == tree_key:
+        return cache['digest']
+
+    changed = [rel for rel, st in stats.items()
+               if rel not in cached_files or
+               (cached_files[rel]['size'], cached_files[rel]['mtime']) != (st['size'], st['mtime'])]
+    hs = hashlib.md5()
+    num_workers = max(num_workers, 1)
+    cancel = threading.Event()
+    in_flight = deque()
+    pending = iter(files)
+
+    with ThreadPoolExecutor(num_workers) as pool, \
+            tqdm(total=sum(st['size'] for st in stats.values()), unit='B', unit_scale=True) as progress:
+
+        def submit():
+            # At most num_workers files are read ahead, in order, so the file consumed below is always being read
+            for fp in itertools.islice(pending, num_workers - len(in_flight)):
+                q = queue.Queue(maxsize=max_chunks)
+                in_flight.append((fp, q, pool.submit(_read_file_chunks, fp, buffer_size, q, cancel)))
+
+        try:
+            submit()
+            while in_flight:
+                fp, q, future = in_flight.popleft()
+                submit()
+                for chunk in _iter_chunks(q, future):
+                    hs.update(chunk)
+                    progress.update(len(chunk))
+                # Raises the error of a failed read (e.g. a file removed since it was listed)
+                future.result()
+        except BaseException:
+            cancel.set()
+            for _, _, future in in_flight:
+                future.cancel()
+            raise
+
+    cache = {
+        'tree': tree_key,
+        'digest': hs.hexdigest(),
+        'files': stats,
+        'changed_files': changed,
+    }
+    try:
+        with open(cache_path, 'w') as f:
+            json.dump(cache, f, indent=1, sort_keys=True)
+    except OSError:
+        pass
+    return cache['digest']
+
+
+class H5FilePool(object):
+    """
+    LRU pool of read-only h5py.File handles owned by the current process.
+
+    Files are opened lazily on first access. A pool that crosses a fork (DataLoader workers) starts empty
+    in the child, so HDF5 state is never shared between processes, and it is pickled without handles.
+    Every thread has its own handles (ThreadPoolLoader), so a handle is never closed by another thread
+    while it is read. h5py still runs one HDF5 call at a time per process.
+    """
+
+    def __init__(self, max_open=16, **h5_kwargs):
+        self.max_open = max_open
+        self.h5_kwargs = h5_kwargs
+        self._pid = None
+        self._local = None
+        self._pools = None
+
+    def _check_pid(self):
+        if self._pid != os.getpid():
+            # Handles inherited from the parent are dropped without closing, the parent still owns them
+            self._local = threading.local()
+            self._pools = []
+            self._pid = os.getpid()
+
+    def _files(self) -> LRUCache:
+        self._check_pid()
+        files = getattr(self._local, 'files', None)
+        if files is None:
+            files = self._local.files = LRUCache(self.max_open, on_evict=lambda fp, hf: hf.close())
+            self._pools.append(files)
+        return files
+
+    def get(self, fp) -> h5py.File:
+        files = self._files()
+        hf = files.get(fp)
+        if hf is None:
+            hf = h5py.File(fp, 'r', **self.h5_kwargs)
+            files.put(fp, hf)
+        return hf
+
+    def close(self):
+        if self._pid == os.getpid():
+            for files in self._pools:
+                files.clear()
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_pid'] = None
+        state['_local'] = None
+        state['_pools'] = None
+        return state
@@ -4,7 +4,9 @@ Copied from https://github.com/facebookresearch/fastMRI
 import torch
 import torch.fft
 import numpy as np
+import scipy.fft
 import contextlib
+from functools import lru_cache
 from typing import Optional, Sequence, Tuple, Union, List
 
 
@@ -145,6 +147,104 @@ def pt_kspace2spatial(k_space: torch.Tensor) -> torch.Tensor:
     return ifftshift(recon)
 
 
+# Threads of a single fft2c / ifft2c call, -1 uses every core
+FFT_WORKERS = 1
+
+
+def set_fft_workers(workers: int):
+    global FFT_WORKERS
+    FFT_WORKERS = workers
+
+
+@lru_cache(maxsize=32)
+def _shift_signs(h: int, w: int) -> Tuple[np.ndarray, np.ndarray]:
+    # For even sizes fftshift(fft(ifftshift(x))) == (-1)^(h/2 + w/2) * C * fft(C * x), C[i, j] = (-1)^(i + j),
+    # the same holds for the inverse transform
+    c = np.ones((h, w), dtype=np.float32)
+    c[1::2, ::2] = -1
+    c[::2, 1::2] = -1
+    sign = -1 if (h // 2 + w // 2) % 2 else 1
+    return c, c * sign
+
+
+def _centered_fft2(x: np.ndarray, inverse: bool, workers: Optional[int]) -> np.ndarray:
+    x = np.asarray(x)
+    workers = FFT_WORKERS if workers is None else workers
+    fft = scipy.fft.ifft2 if inverse else scipy.fft.fft2
+    h, w = x.shape[-2:]
+    if h % 2 or w % 2:
+        pre, post = (np.fft.fftshift, np.fft.ifftshift) if inverse else (np.fft.ifftshift, np.fft.fftshift)
+        x = pre(x.astype(np.complex64), axes=(-2, -1))
+        return post(fft(x, norm='ortho', workers=workers, overwrite_x=True), axes=(-2, -1))
+    pre, post = _shift_signs(h, w)
+    x = fft(x.astype(np.complex64) * pre, norm='ortho', workers=workers, overwrite_x=True)
+    x *= post
+    return x
+
+
+def fft2c(img: np.ndarray, workers: Optional[int] = None) -> np.ndarray:
+    """
+    complex64 spatial2kspace over the last two axes, so a (Z, H, W) volume is a single call.
+    The shifts are folded into sign flips for even sizes.
+
+    Args:
+        img: (..., H, W) real or complex image.
+        workers: FFT threads, FFT_WORKERS by default.
+    """
+    return _centered_fft2(img, False, workers)
+
+
+def ifft2c(k_space: np.ndarray, workers: Optional[int] = None) -> np.ndarray:
+    """complex64 inverse of fft2c, np.abs(ifft2c(k_space)) is kspace2spatial in single precision."""
+    return _centered_fft2(k_space, True, workers)
+
+
+def _centered_fft2_(x: np.ndarray, inverse: bool, workers: Optional[int]) -> np.ndarray:
+    if x.dtype != np.complex64 or not x.flags.c_contiguous or x.shape[-2] % 2 or x.shape[-1] % 2:
+        raise ValueError('In-place FFT needs a C-contiguous complex64 array with even sizes, got %s %s'
+                         % (x.dtype, x.shape))
+    pre, post = _shift_signs(*x.shape[-2:])
+    x *= pre
+    fft = scipy.fft.ifft2 if inverse else scipy.fft.fft2
+    y = fft(x, norm='ortho', workers=FFT_WORKERS if workers is None else workers, overwrite_x=True)
+    if not np.shares_memory(x, y):
+        x[...] = y
+    x *= post
+    return x
+
+
+def fft2c_(x: np.ndarray, workers: Optional[int] = None) -> np.ndarray:
+    """In-place fft2c of a C-contiguous complex64 array with even H and W."""
+    return _centered_fft2_(x, False, workers)
+
+
+def ifft2c_(x: np.ndarray, workers: Optional[int] = None) -> np.ndarray:
+    """In-place ifft2c of a C-contiguous complex64 array with even H and W."""
+    return _centered_fft2_(x, True, workers)
+
+
+def center_crop_kspace(k_space: np.ndarray, target_shape: Sequence[int]) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Center crops k-space in the image domain.
+
+    Args:
+        k_space: Fully sampled (H, W) k-space.
+        target_shape: Shape of the cropped image.
+
+    Returns:
+        tuple containing:
+            complex64 k-space of the cropped magnitude image
+            float32 cropped magnitude image
+    """
+    recon = np.abs(ifft2c(k_space))
+    xs = (k_space.shape[0] - target_shape[0]) // 2
+    ys = (k_space.shape[1] - target_shape[1]) // 2
+    xt = xs + target_shape[0]
+    yt = ys + target_shape[1]
+    recon = recon[xs:xt, ys:yt]
+    return fft2c(recon), recon
+
+
 class MaskFunc:
     """
     An object for GRAPPA-style sampling masks.
@@ -185,6 +285,95 @@ class MaskFunc:
 
         return center_fraction, acceleration
 
+    def batch(
+        self,
+        shape: Sequence[int],
+        num: Optional[int] = None,
+        seeds: Optional[Sequence[Union[int, Tuple[int, ...]]]] = None,
+        pairs: Optional[Sequence[Tuple[float, int]]] = None,
+    ) -> np.ndarray:
+        """
+        Create several masks in one call.
+
+        Args:
+            shape: The shape of a single mask, as for __call__.
+            num: Number of masks, taken from seeds if they are given.
+            seeds: One seed per mask, row i is the same mask __call__(shape, seeds[i])
+                returns. Without seeds all masks are drawn from self.rng at once.
+            pairs: (center_fraction, acceleration) pairs. If given, every mask is built
+                for each pair instead of choosing one, seeded rows restart from their
+                seed for every pair.
+
+        Returns:
+            A (num, *mask_shape) mask array, (len(pairs), num, *mask_shape) if pairs
+            are given.
+        """
+        if len(shape) < 2:
+            raise ValueError("Shape should have 2 or more dimensions")
+        if seeds is not None:
+            num = len(seeds)
+        if num is None:
+            raise ValueError("Either num or seeds should be given")
+
+        num_cols = shape[-1]
+        if type(self).make_masks is MaskFunc.make_masks:
+            # Subclasses without a vectorized implementation
+            if pairs is not None:
+                raise NotImplementedError("%s does not support pairs" % type(self).__name__)
+            seeds = [None] * num if seeds is None else seeds
+            return np.stack([self(shape, seed) for seed in seeds])
+        if pairs is None:
+            masks = self._batch_masks(num_cols, num, seeds)
+        else:
+            masks = np.stack([self._batch_masks(num_cols, num, seeds, pair) for pair in pairs])
+
+        mask_shape = [1 for _ in shape]
+        mask_shape[-1] = num_cols
+        return masks.reshape(*masks.shape[:-1], *mask_shape)
+
+    def _batch_masks(self, num_cols, num, seeds, pair=None) -> np.ndarray:
+        if seeds is None:
+            seeds = [None]
+            rng = self.rng
+        else:
+            # Private generator reseeded per row, self.rng state is never saved or restored
+            rng = np.random.RandomState()  # pylint: disable=no-member
+
+        masks = []
+        for seed in seeds:
+            if seed is None:
+                choice = rng.randint(0, len(self.accelerations), size=num)
+            else:
+                rng.seed(seed)
+                choice = rng.randint(0, len(self.accelerations), size=1)
+            if pair is None:
+                center_fractions = np.asarray(self.center_fractions)[choice]
+                accelerations = np.asarray(self.accelerations)[choice]
+            else:
+                center_fractions = np.full(len(choice), pair[0])
+                accelerations = np.full(len(choice), pair[1])
+            draws = self.draw(rng, num_cols, center_fractions, accelerations)
+            masks.append(self.make_masks(num_cols, center_fractions, accelerations, draws))
+        return np.concatenate(masks).astype(np.float32)
+
+    def draw(self, rng: np.random.RandomState, num_cols: int, center_fractions: np.ndarray,
+             accelerations: np.ndarray) -> np.ndarray:
+        """Random numbers for len(accelerations) masks, drawn in the order __call__ draws them."""
+        raise NotImplementedError
+
+    def make_masks(self, num_cols: int, center_fractions: np.ndarray, accelerations: np.ndarray,
+                   draws: np.ndarray) -> np.ndarray:
+        """Builds (len(accelerations), num_cols) boolean masks from the random numbers of `draw`."""
+        raise NotImplementedError
+
+    @staticmethod
+    def center_masks(num_cols: int, center_fractions: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        num_low_freqs = np.round(num_cols * center_fractions).astype(int)
+        pad = (num_cols - num_low_freqs + 1) // 2
+        cols = np.arange(num_cols)
+        masks = (cols >= pad[:, None]) & (cols < (pad + num_low_freqs)[:, None])
+        return masks, num_low_freqs
+
 
 class RandomMaskFunc(MaskFunc):
     """
@@ -249,6 +438,14 @@ class RandomMaskFunc(MaskFunc):
 
         return mask
 
+    def draw(self, rng, num_cols, center_fractions, accelerations):
+        return rng.uniform(size=(len(accelerations), num_cols))
+
+    def make_masks(self, num_cols, center_fractions, accelerations, draws):
+        masks, num_low_freqs = self.center_masks(num_cols, center_fractions)
+        prob = (num_cols / accelerations - num_low_freqs) / (num_cols - num_low_freqs)
+        return masks | (draws < prob[:, None])
+
 
 class EquispacedMaskFunc(MaskFunc):
     """
@@ -318,6 +515,25 @@ class EquispacedMaskFunc(MaskFunc):
 
         return mask
 
+    @staticmethod
+    def adjusted_accelerations(num_cols, center_fractions, accelerations):
+        num_low_freqs = np.round(num_cols * center_fractions).astype(int)
+        return (accelerations * (num_low_freqs - num_cols)) / (num_low_freqs * accelerations - num_cols)
+
+    def draw(self, rng, num_cols, center_fractions, accelerations):
+        adjusted_accel = self.adjusted_accelerations(num_cols, center_fractions, accelerations)
+        return rng.randint(0, np.round(adjusted_accel).astype(int))
+
+    def make_masks(self, num_cols, center_fractions, accelerations, draws):
+        masks, _ = self.center_masks(num_cols, center_fractions)
+        adjusted_accel = self.adjusted_accelerations(num_cols, center_fractions, accelerations)
+        steps = np.arange(int(np.ceil((num_cols - 1) / adjusted_accel.min())) + 1)
+        accel_samples = draws[:, None] + steps[None, :] * adjusted_accel[:, None]
+        valid = accel_samples < num_cols - 1
+        rows = np.broadcast_to(np.arange(len(draws))[:, None], accel_samples.shape)
+        masks[rows[valid], np.around(accel_samples[valid]).astype(int)] = True
+        return masks
+
 
 def apply_mask(
     data: np.ndarray,
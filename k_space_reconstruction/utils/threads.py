@@ -0,0 +1,122 @@
+import os
+import cv2
+import torch
+from typing import Dict, List, Optional, Sequence
+from k_space_reconstruction.utils.kspace import set_fft_workers
+try:
+    from threadpoolctl import threadpool_limits
+except ImportError:
+    threadpool_limits = None
+
+
+# Read by OpenMP / BLAS runtimes when they start, covers the libraries loaded after the budget is applied
+THREAD_ENV_VARS = ('OMP_NUM_THREADS', 'MKL_NUM_THREADS', 'OPENBLAS_NUM_THREADS', 'NUMEXPR_NUM_THREADS')
+
+
+def available_cores() -> List[int]:
+    """Cores this process may run on, all cores where affinity is not supported."""
+    if hasattr(os, 'sched_getaffinity'):
+        return sorted(os.sched_getaffinity(0))
+    return list(range(os.cpu_count() or 1))
+
+
+def apply_thread_budget(num_threads: int, cores: Optional[Sequence[int]] = None, name: str = 'main',
+                        call_threads: Optional[int] = None) -> Dict[str, object]:
+    """
+    Limits the calling process to `num_threads` threads in torch, BLAS (through threadpoolctl if installed,
+    environment variables otherwise), OpenCV and the scipy FFT of utils.kspace, and pins it to `cores`.
+    `call_threads` overrides the threads of OpenCV and the FFT, which loader threads call concurrently.
+
+    Returns:
+        Dict of what was applied, also printed
+    """
+    call_threads = num_threads if call_threads is None else call_threads
+    applied = {'torch': num_threads, 'cv2': call_threads, 'fft': call_threads}
+    torch.set_num_threads(num_threads)
+    cv2.setNumThreads(call_threads)
+    set_fft_workers(call_threads)
+    for var in THREAD_ENV_VARS:
+        os.environ[var] = str(num_threads)
+    if threadpool_limits is not None:
+        threadpool_limits(limits=num_threads)
+        applied['blas'] = num_threads
+    else:
+        applied['blas'] = 'env'
+    if cores is not None and hasattr(os, 'sched_setaffinity'):
+        os.sched_setaffinity(0, cores)
+        applied['affinity'] = sorted(cores)
+    print('%s (pid %d) thread budget: %s' % (name, os.getpid(), applied))
+    return applied
+
+
+class CoreBudget(object):
+    """
+    Split of the cores between the main process (the model) and `num_workers` DataLoader workers.
+    Every worker gets `worker_threads` cores, the main process keeps the rest, at least `min_main_threads`.
+    With more workers than spare cores, the workers share the spare cores round-robin.
+
+    With `loader_threads` (ThreadPoolLoader) the samples are loaded on threads of the main process instead:
+    torch keeps the cores left over by the loader threads, and OpenCV and the FFT, called by every loader
+    thread at once, run single-threaded. The process stays pinned to all of its cores.
+
+        budget = CoreBudget(num_workers=12)
+        budget.apply_main()
+        loader = DataLoader(dataset, num_workers=12, worker_init_fn=budget.worker_init_fn)
+
+    Args:
+        num_workers: DataLoader workers per main process.
+        worker_threads: Threads (and cores) of every worker.
+        min_main_threads: Cores kept by the main process, the workers get the others.
+        cores: Cores to split, the affinity of the calling process by default.
+        local_rank, local_world_size: With several training processes per node every process splits
+            its own contiguous share of `cores`.
+        loader_threads: Loader threads of the main process, their cores are taken from torch.
+    """
+
+    def __init__(self, num_workers: int, worker_threads: int = 1, min_main_threads: int = 1,
+                 cores: Optional[Sequence[int]] = None, local_rank: int = 0, local_world_size: int = 1,
+                 loader_threads: int = 0):
+        cores = list(cores) if cores is not None else available_cores()
+        share = max(len(cores) // local_world_size, 1)
+        self.cores = cores[local_rank * share % len(cores):][:share]
+        self.num_workers = num_workers
+        self.worker_threads = worker_threads
+        self.loader_threads = loader_threads
+        if loader_threads:
+            self.main_cores = self.cores
+        elif not num_workers:
+            self.main_cores = self.cores
+        else:
+            main = max(len(self.cores) - num_workers * worker_threads, min(min_main_threads, len(self.cores)))
+            self.main_cores = self.cores[:main]
+        self.spare_cores = self.cores[len(self.main_cores):] or self.cores
+
+    def worker_cores(self, worker_id: int) -> List[int]:
+        start = worker_id * self.worker_threads
+        return [self.spare_cores[(start + i) % len(self.spare_cores)] for i in range(self.worker_threads)]
+
+    @classmethod
+    def from_env(cls, num_workers: int, **kwargs) -> 'CoreBudget':
+        """Budget of the calling training process, LOCAL_RANK and LOCAL_WORLD_SIZE as set by torchrun."""
+        return cls(num_workers, local_rank=int(os.environ.get('LOCAL_RANK', 0)),
+                   local_world_size=int(os.environ.get('LOCAL_WORLD_SIZE', 1)), **kwargs)
+
+    @property
+    def main_threads(self) -> int:
+        """torch threads of the main process."""
+        if self.loader_threads:
+            return max(len(self.cores) - self.loader_threads, 1)
+        return len(self.main_cores)
+
+    def apply_main(self) -> Dict[str, object]:
+        return apply_thread_budget(self.main_threads, self.main_cores, call_threads=1 if self.loader_threads else None)
+
+    def worker_init_fn(self, worker_id: int):
+        apply_thread_budget(self.worker_threads, self.worker_cores(worker_id), 'worker %d' % worker_id)
+
+    def __repr__(self):
+        if self.loader_threads:
+            return 'CoreBudget(main=%d threads, %d loader threads on %s)' % (
+                self.main_threads, self.loader_threads, self.main_cores)
+        return 'CoreBudget(main=%s, workers=%d x %d threads on %s)' % (
+            self.main_cores, self.num_workers, self.worker_threads, self.spare_cores)
@@ -9,6 +9,8 @@ import pytorch_lightning as pl
 from pytorch_lightning.callbacks import Callback, ModelCheckpoint
 from k_space_reconstruction.nets.cdn_dncnn import DnCNNDCLModule, CascadeModule
 from k_space_reconstruction.datasets.fastmri import FastMRITransform, FastMRIh5Dataset, RandomMaskFunc
+from k_space_reconstruction.datasets.memmap import FastMRIMemmapDataset
+from k_space_reconstruction.datasets.autotune import loader_profile_kwargs
 from k_space_reconstruction.utils.metrics import pt_msssim, pt_ssim, ssim, nmse, psnr
 from k_space_reconstruction.utils.loss import l1_loss, compund_mssim_l1_loss
 from k_space_reconstruction.utils.kspace import spatial2kspace, kspace2spatial
@@ -18,6 +20,10 @@ print('Available GPUs: ', torch.cuda.device_count())
 
 torch.manual_seed(42)
 np.random.seed(42)
+# KSR_MEMMAP=1 reads cropped slices from a memory-mapped store built next to each .h5, see datasets/memmap.py
+dataset_cls = FastMRIMemmapDataset if os.environ.get('KSR_MEMMAP') == '1' else FastMRIh5Dataset
+# Workers and prefetching of this machine, see datasets/autotune.py
+loader_kwargs = loader_profile_kwargs(dataset_cls.__name__)
 
 path = 'cascade-x5-dncnn-dcl-noiseless.pth' #<------------------------Path-to-the-cascade-wegihts----------------------
 batch_size = 8
@@ -61,10 +67,10 @@ transform = FastMRITransform(
     noise_type='normal'
 )
 
-train_dataset = FastMRIh5Dataset('small_fastmri_pd_3t/train.h5', transform)
-val_dataset = FastMRIh5Dataset('small_fastmri_pd_3t/val.h5', transform)
-train_generator = torch.utils.data.DataLoader(train_dataset, batch_size=batch_size, num_workers=12, shuffle = True)
-val_generator = torch.utils.data.DataLoader(val_dataset, batch_size=1, num_workers=12, shuffle = True)
+train_dataset = dataset_cls('small_fastmri_pd_3t/train.h5', transform)
+val_dataset = dataset_cls('small_fastmri_pd_3t/val.h5', transform)
+train_generator = torch.utils.data.DataLoader(train_dataset, batch_size=batch_size, **loader_kwargs, shuffle = True)
+val_generator = torch.utils.data.DataLoader(val_dataset, batch_size=1, **loader_kwargs, shuffle = True)
 
 cascade = CascadeModule(net=torch.nn.ModuleList([DnCNNDCLModule(**model_kwargs).net for _ in range(5)]), **model_kwargs)
 cascade.net.load_state_dict(torch.load(path))
@@ -100,10 +106,10 @@ transform = FastMRITransform(
     noise_type='salt'
 )
 
-train_dataset = FastMRIh5Dataset('small_fastmri_pd_3t/train.h5', transform)
-val_dataset = FastMRIh5Dataset('small_fastmri_pd_3t/val.h5', transform)
-train_generator = torch.utils.data.DataLoader(train_dataset, batch_size=batch_size, num_workers=12, shuffle = True)
-val_generator = torch.utils.data.DataLoader(val_dataset, batch_size=1, num_workers=12, shuffle = True)
+train_dataset = dataset_cls('small_fastmri_pd_3t/train.h5', transform)
+val_dataset = dataset_cls('small_fastmri_pd_3t/val.h5', transform)
+train_generator = torch.utils.data.DataLoader(train_dataset, batch_size=batch_size, **loader_kwargs, shuffle = True)
+val_generator = torch.utils.data.DataLoader(val_dataset, batch_size=1, **loader_kwargs, shuffle = True)
 
 cascade = CascadeModule(net=torch.nn.ModuleList([DnCNNDCLModule(**model_kwargs).net for _ in range(5)]), **model_kwargs)
 cascade.net.load_state_dict(torch.load(path))
@@ -139,10 +145,10 @@ transform = FastMRITransform(
     noise_type='normal_and_salt'
 )
 
-train_dataset = FastMRIh5Dataset('small_fastmri_pd_3t/train.h5', transform)
-val_dataset = FastMRIh5Dataset('small_fastmri_pd_3t/val.h5', transform)
-train_generator = torch.utils.data.DataLoader(train_dataset, batch_size=batch_size, num_workers=12, shuffle = True)
-val_generator = torch.utils.data.DataLoader(val_dataset, batch_size=1, num_workers=12, shuffle = True)
+train_dataset = dataset_cls('small_fastmri_pd_3t/train.h5', transform)
+val_dataset = dataset_cls('small_fastmri_pd_3t/val.h5', transform)
+train_generator = torch.utils.data.DataLoader(train_dataset, batch_size=batch_size, **loader_kwargs, shuffle = True)
+val_generator = torch.utils.data.DataLoader(val_dataset, batch_size=1, **loader_kwargs, shuffle = True)
 
 cascade = CascadeModule(net=torch.nn.ModuleList([DnCNNDCLModule(**model_kwargs).net for _ in range(5)]), **model_kwargs)
 cascade.net.load_state_dict(torch.load(path))